@@ -0,0 +1,54 @@
+"""
+Benchmarks comparing the rsync and tar stream transfers of deploy_files.
+
+Not run by ``fab test``. Run with ``fab bench_dep_transfer``
+"""
+from fabric.api import sudo, settings
+
+import os, random, shutil, tempfile, time
+
+from woven.deployment import COMPRESSORS, _compressor, _local_tree, close_ssh_master, rsync, tar_stream
+
+H = '192.168.188.10'
+HS = 'root@192.168.188.10:22'
+R = 'root'
+
+def _make_tree(files, size):
+    """
+    A synthetic tree of ``files`` files of ``size`` bytes in directories of 100
+    """
+    local_dir = tempfile.mkdtemp()
+    words = ['def','class','return','import','self','django','woven','template']
+    for i in range(files):
+        dir = os.path.join(local_dir,'d%s'% (i/100))
+        if not os.path.exists(dir): os.mkdir(dir)
+        content = ' '.join([random.choice(words) for w in range(size/6)])[:size]
+        open(os.path.join(dir,'f%s.py'% i),'w').write(content)
+    return local_dir
+
+def _time(func, *args):
+    sudo('rm -rf /tmp/woven-bench && mkdir -p /tmp/woven-bench')
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+def bench_dep_transfer():
+    trees = [('10000 x 1KB', _make_tree(10000, 1024)),
+             ('1000 x 10KB', _make_tree(1000, 10240)),
+             ('10 x 5MB', _make_tree(10, 5*1024*1024))]
+    with settings(hosts=[H],host=H,host_string=HS,user=R,password=R,port='22'):
+        remote_compressors = [c[0] for c in COMPRESSORS]
+        for name, local_dir in trees:
+            print name
+            print ' * rsync %.2fs'% _time(rsync, local_dir+'/', '/tmp/woven-bench/')
+            local_files = _local_tree(local_dir)
+            for compressor in COMPRESSORS + [('none','cat','cat')]:
+                with settings(DEPLOY_COMPRESSION=compressor[0]):
+                    try:
+                        compressor = _compressor(remote_compressors)
+                    except SystemExit:
+                        continue
+                print ' * tar %s %.2fs'% (compressor[0], _time(tar_stream, local_dir, '/tmp/woven-bench', local_files, compressor))
+            shutil.rmtree(local_dir)
+        close_ssh_master()
+        sudo('rm -rf /tmp/woven-bench')
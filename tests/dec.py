@@ -5,6 +5,7 @@ Tests the decorators.py module
 from fabric.api import settings, sudo
 
 from woven.decorators import run_once_per_node, run_once_per_version
+from woven.environment import clear_state_snapshot
 
 H = '192.168.188.10'
 HS = 'root@192.168.188.10:22'
@@ -13,6 +14,7 @@ R = 'root'
 def teardown():
     with settings(host_string=HS,user=R,password=R,project_fullname='example-0.2'):
         sudo('rm -rf /var/local/woven')
+        clear_state_snapshot()
 
 def test_dec_run_once_per_node():
     teardown()
@@ -46,4 +48,22 @@ def test_dec_run_once_per_version():
         assert not test_func()
         
     teardown()
-    
\ No newline at end of file
+    
+def test_dec_run_once_fingerprint():
+    teardown()
+    inputs = ['a']
+    
+    @run_once_per_version(fingerprint=lambda: inputs[0])
+    def test_func():
+        return 'some'
+    
+    with settings(host=H,host_string=HS,user=R,password=R,project_fullname='example-0.2'):
+        assert test_func() == 'some'
+        #patching with unchanged inputs is skipped
+        with settings(patch=True):
+            assert not test_func()
+            inputs[0] = 'b'
+            assert test_func() == 'some'
+            assert not test_func()
+        
+    teardown()
@@ -1,7 +1,11 @@
 from fabric.contrib.files import exists
 from fabric.api import sudo, settings
 
-from woven.deployment import _backup_file, _restore_file
+import json, os, tempfile
+
+from woven.deployment import _backup_file, _restore_file, _get_local_files, _manifest_changes, local_manifest
+from woven.deployment import batch, deploy_files, rsync, tar_stream, close_ssh_master, upload_templates
+from woven.deployment import render_template, render_cache_stats
 
 H = '192.168.188.10'
 HS = 'root@192.168.188.10:22'
@@ -13,8 +17,112 @@ def test_dep_backup_file():
         _backup_file('/etc/ssh/sshd_config')
         assert exists('/var/local/woven-backup/etc/ssh/sshd_config')
         sudo('rm -rf /var/local/woven-backup')
-        
-        
-    
 
+def test_dep_rsync():
+    local_dir = tempfile.mkdtemp()
+    open(os.path.join(local_dir,'a.txt'),'w').write('a')
+    with settings(hosts=[H],host=H,host_string=HS,user=R,password=R,port='22'):
+        sudo('rm -rf /tmp/woven-rsync')
+        rsync(local_dir,'/tmp/woven-rsync')
+        rsync(local_dir,'/tmp/woven-rsync',delete=True)
+        assert exists('/tmp/woven-rsync/%s/a.txt'% os.path.basename(local_dir))
+        #the second rsync reused the first connection
+        assert close_ssh_master() == 1
+        sudo('rm -rf /tmp/woven-rsync')
+
+def test_dep_batch():
+    with settings(hosts=[H],host_string=HS,user=R,password=R):
+        with batch() as b:
+            first = b.run('echo one')
+            second = b.sudo('echo two')
+        assert first.output == 'one' and second.output == 'two'
+        assert first.succeeded and second.return_code == 0
+        #without fail_fast every command runs
+        with batch(fail_fast=False) as b:
+            failed = b.run('false')
+            after = b.run('echo after')
+        assert failed.failed and after.output == 'after'
+
+def test_dep_deploy_files_link_dest():
+    local_dir = tempfile.mkdtemp()
+    open(os.path.join(local_dir,'a.txt'),'w').write('a')
+    with settings(hosts=[H],host=H,host_string=HS,user=R,password=R,port='22',
+                  DEPLOYMENT_ROOT='/tmp/woven-link',project_name='example',project_fullname='example-0.1'):
+        sudo('rm -rf /tmp/woven-link')
+        created = deploy_files(local_dir,'/tmp/woven-link/env/example-0.1/project')
+        assert '/tmp/woven-link/env/example-0.1/project/a.txt' in created
+        sudo('ln -s /tmp/woven-link/env/example-0.1 /tmp/woven-link/env/example')
+        with settings(project_fullname='example-0.2'):
+            created = deploy_files(local_dir,'/tmp/woven-link/env/example-0.2/project')
+        assert '/tmp/woven-link/env/example-0.2/project/a.txt' in created
+        #the unchanged file is a hard link to the active version's copy
+        assert sudo('stat -c %h /tmp/woven-link/env/example-0.2/project/a.txt') == '2'
+        sudo('rm -rf /tmp/woven-link')
+
+def test_dep_deploy_files_manifest():
+    local_dir = tempfile.mkdtemp()
+    open(os.path.join(local_dir,'a.txt'),'w').write('a')
+    with settings(hosts=[H],host=H,host_string=HS,user=R,password=R,port='22'):
+        sudo('rm -rf /tmp/woven-manifest')
+        deploy_files(local_dir,'/tmp/woven-manifest/files')
+        #the state only holds a digest of the manifest beside the directory
+        manifest = json.loads(sudo('cat /tmp/woven-manifest/.manifest-*.json'))
+        assert manifest.keys() == ['a.txt']
+        assert deploy_files(local_dir,'/tmp/woven-manifest/files') == []
+        open(os.path.join(local_dir,'c.txt'),'w').write('c')
+        assert deploy_files(local_dir,'/tmp/woven-manifest/files') == ['/tmp/woven-manifest/files/c.txt']
+        sudo('rm -rf /tmp/woven-manifest')
+
+def test_dep_get_local_files():
+    local_dir = tempfile.mkdtemp()
+    for path in ['req.txt','static/css/a.css','static/css/ie/b.css','static/a.pyc','pkg/m.py']:
+        if not os.path.exists(os.path.join(local_dir,os.path.dirname(path))):
+            os.makedirs(os.path.join(local_dir,os.path.dirname(path)))
+        open(os.path.join(local_dir,path),'w').write(path)
+    local_files = _get_local_files(local_dir,'req*|static/**/*.css|pkg',['*.pyc'])
+    assert local_files == {'':['req.txt'],'static/css':['a.css'],'static/css/ie':['b.css'],'pkg':['m.py']}
+    assert _get_local_files(local_dir,'nomatch') == {}
+
+def test_dep_local_manifest():
+    local_dir = tempfile.mkdtemp()
+    open(os.path.join(local_dir,'a.txt'),'w').write('a')
+    open(os.path.join(local_dir,'b.pyc'),'w').write('b')
+    manifest = local_manifest(local_dir)
+    assert manifest.keys() == ['a.txt'] and manifest['a.txt'][0] == 1
+    open(os.path.join(local_dir,'c.txt'),'w').write('c')
+    assert _manifest_changes(local_manifest(local_dir),manifest) == {'':['c.txt']}
+
+def test_dep_tar_stream():
+    local_dir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(local_dir,'empty'))
+    open(os.path.join(local_dir,'a.txt'),'w').write('a')
+    with settings(hosts=[H],host=H,host_string=HS,user=R,password=R,port='22'):
+        sudo('rm -rf /tmp/woven-tar && mkdir /tmp/woven-tar')
+        tar_stream(local_dir,'/tmp/woven-tar',{'':['a.txt'],'empty':[]})
+        assert exists('/tmp/woven-tar/a.txt') and exists('/tmp/woven-tar/empty')
+        close_ssh_master()
+        sudo('rm -rf /tmp/woven-tar')
+
+def test_dep_upload_templates():
+    with settings(hosts=[H],host=H,host_string=HS,user=R,password=R,port='22'):
+        sudo('rm -rf /tmp/woven-templates')
+        sudo('mkdir /tmp/woven-templates')
+        templates = [('woven/maintenance.html','/tmp/woven-templates/a.html',{}),
+                     ('woven/maintenance.html','/tmp/woven-templates/b.html',{},'ugo+r')]
+        uploaded = upload_templates(templates,use_sudo=True,owner='root:root')
+        assert uploaded == ['/tmp/woven-templates/a.html','/tmp/woven-templates/b.html']
+        #unchanged templates are not sent again
+        assert upload_templates(templates,use_sudo=True) == []
+        sudo('rm -rf /tmp/woven-templates /var/local/woven-backup/tmp/woven-templates')
 
+def test_dep_render_template():
+    with settings(host_string=HS):
+        cached, rendered = render_cache_stats()
+        text = render_template('woven/maintenance.html',{'domain':'example.com'})
+        assert render_template('woven/maintenance.html',{'domain':'example.com'}) == text
+        assert render_cache_stats()[0] == cached + 1
+        #objects that aren't json are never part of the key
+        site = object()
+        render_template('woven/maintenance.html',{'domain':'example.com','site':site})
+        render_template('woven/maintenance.html',{'domain':'example.com','site':site})
+        assert render_cache_stats() == (cached + 1, rendered + 3)
@@ -1,19 +1,24 @@
 
 from fabric.api import *
+from fabric.contrib.files import exists
 from fabric.state import env
 
 from woven.environment import _root_domain, _parse_project_version
 from woven.environment import set_env, server_state, set_server_state
-from woven.environment import version_state, set_version_state
+from woven.environment import version_state, set_version_state, clear_state_snapshot
+from woven.environment import begin_state_journal, flush_state_journal, SQLiteStateStore
+from woven.environment import compact_state, DeployContext, _ContextDict
 H = '192.168.188.10'
 HS = 'root@192.168.188.10:22'
 R = 'root'
 
 def setup():
     sudo('rm -rf /var/local/woven')
+    clear_state_snapshot()
 
 def teardown():
     sudo('rm -rf /var/local/woven')
+    clear_state_snapshot()
     
 def test_env_set_env():
     print "TEST SET ENV"
@@ -24,6 +29,7 @@ def test_env_server_state():
         setup()
         env.project_fullname = 'example_project-0.1'
         sudo('rm -rf /var/local/woven')
+        clear_state_snapshot()
         #test
         set_server_state('example',delete=True)
         set_server_state('example')
@@ -42,6 +48,7 @@ def test_env_version_state():
         setup()
         env.project_fullname = 'example_project-0.1'
         sudo('rm -rf /var/local/woven')
+        clear_state_snapshot()
         #test
         set_version_state('example',delete=True)
         set_version_state('example')
@@ -56,8 +63,127 @@ def test_env_version_state():
         state = version_state('example')
         assert not state
         teardown()
+
+def test_env_state_snapshot():
+    with settings(host_string=HS,user=R,password=R):
+        setup()
+        env.project_fullname = 'example_project-0.1'
+        set_version_state('example',object=['something'])
+        #a fresh snapshot must see the state written before it
+        clear_state_snapshot()
+        assert version_state('example') == ['something']
+        assert version_state('example', prefix=True)
+        #the cached snapshot follows woven's own writes
+        set_version_state('example',delete=True)
+        assert not version_state('example')
+        clear_state_snapshot()
+        assert not version_state('example')
+        teardown()
+
+def test_env_state_without_snapshot():
+    with settings(host_string=HS,user=R,password=R,STATE_SNAPSHOT=False):
+        setup()
+        env.project_fullname = 'example_project-0.1'
+        #each state file is written on its own
+        set_version_state('example',object=['something'])
+        assert sudo('cat /var/local/woven/example_project-0.1-example') == '["something"]'
+        assert version_state('example') == ['something']
+        set_version_state('example',delete=True)
+        assert not exists('/var/local/woven/example_project-0.1-example')
+    with settings(host_string=HS,user=R,password=R):
+        #the index is rebuilt for the next snapshot
+        set_server_state('example')
+        with settings(STATE_SNAPSHOT=False):
+            set_server_state('other')
+        clear_state_snapshot()
+        assert server_state('example') and server_state('other')
+        teardown()
+
+def test_env_state_journal():
+    with settings(host_string=HS,user=R,password=R):
+        setup()
+        env.project_fullname = 'example_project-0.1'
+        begin_state_journal()
+        set_version_state('example',object=['something'])
+        set_version_state('other')
+        set_version_state('other',delete=True)
+        #buffered writes are visible before they are flushed
+        assert version_state('example') == ['something']
+        assert not exists('/var/local/woven/example_project-0.1-example')
+        flush_state_journal(end=True)
+        clear_state_snapshot()
+        assert version_state('example') == ['something']
+        assert not version_state('other')
+        assert not exists('/var/local/woven/.journal')
+        teardown()
+
+def test_env_compact_state():
+    with settings(host_string=HS,user=R,password=R,DEPLOYMENT_ROOT='/tmp/woven-compact',project_name='example_project'):
+        setup()
+        sudo('mkdir -p /tmp/woven-compact/env/example_project-0.2')
+        with settings(project_fullname='example_project-0.1'):
+            set_version_state('example')
+        with settings(project_fullname='example_project-0.2'):
+            set_version_state('example')
+            #task names may contain a '-'
+            set_version_state('manifest-0123456789ab')
+        #deployed by other projects, even one sharing the name as a prefix, or deployment roots
+        with settings(project_name='other_project',project_fullname='other_project-0.1'):
+            set_version_state('example')
+        with settings(project_name='example_project-api',project_fullname='example_project-api-0.1'):
+            set_version_state('example')
+        set_server_state('example')
+        with settings(project_fullname='example_project-0.2'):
+            removed = compact_state()
+        assert removed == ['example_project-0.1-example']
+        with settings(project_fullname='other_project-0.1'):
+            assert version_state('example')
+        with settings(project_fullname='example_project-api-0.1'):
+            assert version_state('example')
+        with settings(project_fullname='example_project-0.2'):
+            assert version_state('example')
+            assert version_state('manifest-0123456789ab')
+            assert version_state('example', prefix=True)
+        assert server_state('example')
+        assert exists('/var/local/woven/.index')
+        sudo('rm -rf /tmp/woven-compact')
+        teardown()
+
+def test_env_sqlite_state_store():
+    local('rm -rf .woven')
+    with settings(host_string=HS,user=R,password=R,state_store=SQLiteStateStore()):
+        setup()
+        env.project_fullname = 'example_project-0.1'
+        set_version_state('example',object=['something'])
+        assert version_state('example') == ['something']
+        assert env.state_store.hosts('example','example_project-0.1') == [HS]
+        assert not env.state_store.verify()
+        #a change made behind woven's back shows up in verify
+        sudo('rm -f /var/local/woven/example_project-0.1-example')
+        assert env.state_store.verify()
+        env.state_store.sync()
+        assert not version_state('example')
+        teardown()
+    local('rm -rf .woven')
     
         
+def test_env_deploy_context():
+    env.domains = 'example.com'
+    with DeployContext(HS) as context:
+        assert env.host_string == HS
+        assert env.user == R and env.host == H
+        #writes are only seen in the context
+        env.domains = 'host.example.com'
+        with settings(warn_only=True):
+            assert env.warn_only
+        with DeployContext(parent=context):
+            assert env.domains == 'host.example.com'
+            env.domains = 'task.example.com'
+        assert env.domains == 'host.example.com'
+    assert env.domains == 'example.com'
+    #fabric's env is only changed while a context is active
+    assert not isinstance(env, _ContextDict)
+    
 def test_env_parse_project_version():
     v = _parse_project_version('0.1')
     env.project_version = ''
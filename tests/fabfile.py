@@ -26,16 +26,28 @@ from woven.environment import set_env
 
 #import tests
 from env import test_env_set_env, test_env_server_state, test_env_parse_project_version, test_env_root_domain
-from env import test_env_version_state
+from env import test_env_version_state, test_env_state_snapshot, test_env_state_journal, test_env_state_without_snapshot
+from env import test_env_sqlite_state_store, test_env_compact_state, test_env_deploy_context
 
 #from ubu import test_ubu_disable_root, test_ubu_change_ssh_port, test_ubu_port_is_open
 #from ubu import test_ubu_setup_ufw, test_ubu_post_install_package, test_ubu_post_setupnode
 
-from web import test_web_site_users
+from web import test_web_site_users, test_web_health_check
 from lin import test_lin_add_repositories, test_lin_uninstall_packages
-from lin import test_lin_setup_ufw_rules, test_lin_disable_root
-from dec import test_dec_run_once_per_node, test_dec_run_once_per_version
-from dep import test_dep_backup_file
+from lin import test_lin_setup_ufw_rules, test_lin_disable_root, test_lin_etc_templates
+from lin import test_lin_apt_transaction, test_lin_upgrade_packages, test_lin_package_cache
+from dec import test_dec_run_once_per_node, test_dec_run_once_per_version, test_dec_run_once_fingerprint
+from dep import test_dep_backup_file, test_dep_rsync, test_dep_batch, test_dep_deploy_files_link_dest
+from dep import test_dep_get_local_files, test_dep_local_manifest, test_dep_tar_stream, test_dep_upload_templates
+from dep import test_dep_deploy_files_manifest, test_dep_render_template
+from sch import test_sch_run_tasks, test_sch_run_tasks_state_journal, test_sch_critical_path
+from tra import test_tra_put_file
+from fil import test_fil_file_cache
+from pac import test_pac_compare_versions, test_pac_package_inventory
+from fac import test_fac_host_facts
+from man import test_man_parallel_workers, test_man_rolling_waves, test_man_unavailable_slots
+
+from bench import bench_dep_transfer
 
 #Set the environ for Django
 settings_module = os.environ['DJANGO_SETTINGS_MODULE'] = 'example_project.setting'
@@ -104,6 +116,40 @@ def test_dep():
     """
     _run_tests('dep')
 
+def test_sch():
+    """
+    Run all scheduler tests
+    """
+    _run_tests('sch')
+
     
 
+def test_tra():
+    """
+    Run all transfer tests
+    """
+    _run_tests('tra')
+
+def test_fil():
+    """
+    Run all remote file cache tests
+    """
+    _run_tests('fil')
+
+def test_pac():
+    """
+    Run all package inventory tests
+    """
+    _run_tests('pac')
+
+def test_fac():
+    """
+    Run all host facts tests
+    """
+    _run_tests('fac')
 
+def test_man():
+    """
+    Run all management command tests
+    """
+    _run_tests('man')
@@ -0,0 +1,23 @@
+from fabric.api import run, settings
+
+from woven.facts import host_facts, forget_facts, template_facts
+from woven.linux import lsb_release
+
+H = '192.168.188.10'
+HS = 'root@192.168.188.10:22'
+R = 'root'
+
+def test_fac_host_facts():
+    with settings(hosts=[H],host_string=HS,user=R,password=R,FACTS_TTL=3600):
+        forget_facts()
+        facts = host_facts()
+        assert facts.base == 'debian'
+        assert facts.codename == run('lsb_release -cs').strip()
+        assert facts.cpus >= 1 and facts.memory > 0 and facts.disk_free > 0
+        assert facts.python_version.startswith(run('python -c "import platform; print platform.python_version()"').strip())
+        assert facts.ip
+        #kept for the run and in .woven/facts for later runs
+        assert host_facts() is facts
+        assert lsb_release().codename == facts.codename
+        assert 'disk_free' not in template_facts()
+        forget_facts()
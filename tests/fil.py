@@ -0,0 +1,31 @@
+from fabric.api import sudo, settings
+
+from woven.files import append, contains, exists, forget, prefetch, file_cache_stats, clear_file_cache
+
+H = '192.168.188.10'
+HS = 'root@192.168.188.10:22'
+R = 'root'
+
+def test_fil_file_cache():
+    with settings(hosts=[H],host_string=HS,user=R,password=R):
+        clear_file_cache()
+        sudo('rm -f /tmp/woven-cache.txt')
+        #every existing path is found, not just the last line of the output
+        assert prefetch(['/etc/hosts','/etc/passwd','/tmp/woven-cache.txt'],use_sudo=True) == set(['/etc/hosts','/etc/passwd'])
+        assert exists('/etc/hosts') and exists('/etc/passwd') and not exists('/tmp/woven-cache.txt')
+        append('woven','/tmp/woven-cache.txt')
+        #known from the append without asking the host
+        assert exists('/tmp/woven-cache.txt') and contains('woven','/tmp/woven-cache.txt')
+        sudo('rm -f /tmp/woven-cache.txt')
+        forget('/tmp/woven-cache.txt')
+        assert not exists('/tmp/woven-cache.txt')
+        saved, made = file_cache_stats()
+        assert saved == 5 and made == 3
+        #a path missing without sudo is asked about again with sudo
+        assert not exists('/tmp/woven-cache.txt') and not exists('/tmp/woven-cache.txt',use_sudo=True)
+        assert file_cache_stats() == (5, 5)
+        #and so is text missing from a file
+        assert not contains('woven','/etc/hosts') and not contains('woven','/etc/hosts')
+        assert not contains('woven','/etc/hosts',use_sudo=True) and not contains('woven','/etc/hosts')
+        assert file_cache_stats() == (6, 8)
+        clear_file_cache()
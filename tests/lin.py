@@ -8,8 +8,9 @@ from fabric.network import join_host_strings, normalize
 
 from woven.linux import disable_root, change_ssh_port, port_is_open, setup_ufw
 from woven.linux import setup_ufw_rules
-from woven.linux import uninstall_packages
-from woven.linux import add_repositories
+from woven.linux import uninstall_packages, upgrade_packages
+from woven.linux import add_repositories, _etc_templates, _apt_transaction
+from woven.linux import _package_caches, _collect_package_cache, PACKAGE_CACHE_DIR
 
 from woven.environment import server_state, set_server_state
 
@@ -161,4 +162,68 @@ def test_lin_setup_ufw():
 
 def test_lin_uninstall_packages():
     uninstall_packages()
+
+def test_lin_upgrade_packages():
+    with settings(host_string=HS,user=R,password=R):
+        set_server_state('apt-packages',delete=True)
+        upgrade_packages()
+        state = server_state('apt-packages')
+        assert state['updated'] and state['upgraded'] >= state['updated']
+        #nothing to do on a converged node
+        upgrade_packages()
+        assert server_state('apt-packages')['updated'] == state['updated']
+
+def test_lin_package_cache():
+    local_cache = os.path.join(os.path.split(os.path.realpath(__file__))[0],'package_cache')
+    mirror = '/tmp/woven-mirror'
+    with settings(host_string=HS,user=R,password=R,PACKAGE_CACHE=local_cache):
+        #a local repository standing in for the mirror. apt copies from copy: sources into its cache
+        #where it only uses file: sources in place. The apt on 10.04 has no [trusted=yes] so the
+        #unsigned repository is allowed for the test instead
+        sudo('apt-get install -qqy dpkg-dev')
+        run('mkdir -p %s/pkg/DEBIAN'% mirror)
+        run('printf "Package: woven-test\\nVersion: 1.0\\nArchitecture: all\\nMaintainer: woven\\nDescription: woven test\\n" > %s/pkg/DEBIAN/control'% mirror)
+        run('dpkg-deb --build %s/pkg %s/woven-test_1.0_all.deb'% (mirror,mirror))
+        run('cd %s && dpkg-scanpackages . /dev/null > Packages'% mirror)
+        sudo('echo "deb copy:%s ./" > /etc/apt/sources.list.d/woven-test.list'% mirror)
+        sudo('echo \'APT::Get::AllowUnauthenticated "true";\' > /etc/apt/apt.conf.d/99woven-test')
+        sudo('apt-get -qqy update')
+        
+        #the first host downloads from the mirror and the package is collected
+        outcomes = _apt_transaction('install',['woven-test'])
+        assert outcomes == {'woven-test':True}
+        _collect_package_cache()
+        release = os.listdir(local_cache)[0]
+        assert 'woven-test_1.0_all.deb' in os.listdir(os.path.join(local_cache,release,'debs'))
+        
+        #the next host gets it from the cache without the mirror
+        _apt_transaction('autoremove --purge',['woven-test'])
+        run('rm -f %s/woven-test_1.0_all.deb'% mirror)
+        sudo('rm -rf %s'% PACKAGE_CACHE_DIR)
+        _package_caches.clear()
+        outcomes = _apt_transaction('install',['woven-test'])
+        assert outcomes == {'woven-test':True}
+        
+        #teardown
+        _apt_transaction('autoremove --purge',['woven-test','dpkg-dev'])
+        sudo('rm -rf %s %s /etc/apt/sources.list.d/woven-test.list /etc/apt/apt.conf.d/99woven-test'% (PACKAGE_CACHE_DIR,mirror))
+        sudo('apt-get -qqy update')
+        _package_caches.clear()
+        local('rm -rf %s'% local_cache)
+
+def test_lin_apt_transaction():
+    with settings(host_string=HS,user=R,password=R):
+        #one bad package falls back to installing each package on its own
+        outcomes = _apt_transaction('install',['tree','woven-no-such-package'])
+        assert outcomes == {'tree':True,'woven-no-such-package':False}
+        assert 'tree' in run("dpkg -l | awk '/ii/ {print $2}'").split('\n')
+        #teardown
+        outcomes = _apt_transaction('autoremove --purge',['tree'])
+        assert outcomes == {'tree':True}
     
+
+def test_lin_etc_templates():
+    inventory = _etc_templates()
+    assert ('woven/etc/nginx/nginx.conf','/etc/nginx/nginx.conf') in inventory['/etc/nginx']
+    #built once per run
+    assert _etc_templates() is inventory
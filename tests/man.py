@@ -0,0 +1,103 @@
+"""
+Tests the management/base.py module without connecting to any host
+"""
+import os, sys, tempfile, threading, time
+
+from fabric.api import settings
+from fabric.state import env
+
+from woven.management.base import WovenCommand
+
+HOSTS = ['ok.example.com','fail.example.com']
+
+class ExampleCommand(WovenCommand):
+    def _handle_host(self, *args, **options):
+        print 'handled'
+        if env.host_string.startswith('fail'): sys.exit(2)
+
+class RollingCommand(WovenCommand):
+    """
+    Records how many hosts run, and how many hold an unavailable slot as
+    ``activate`` does, at the same time
+    """
+    def __init__(self, fail=None):
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.handled = []
+        self.running = self.most_running = 0
+        self.unavailable = self.most_unavailable = 0
+
+    def _handle_host(self, *args, **options):
+        with self.lock:
+            self.handled.append(env.host_string)
+            self.running += 1
+            self.most_running = max(self.running, self.most_running)
+        slots = env.get('unavailable_slots')
+        slots.acquire()
+        try:
+            with self.lock:
+                self.unavailable += 1
+                self.most_unavailable = max(self.unavailable, self.most_unavailable)
+            time.sleep(0.2)
+            with self.lock: self.unavailable -= 1
+        finally:
+            slots.release()
+            with self.lock: self.running -= 1
+        if env.host_string == self.fail: sys.exit(1)
+
+def _run_parallel(**options):
+    """
+    Runs ExampleCommand on HOSTS at once and returns its (exit code, output)
+    """
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    stdout = sys.stdout
+    sys.stdout = open(path,'w')
+    code = 0
+    try:
+        ExampleCommand()._run_hosts_parallel(HOSTS, 2, **options)
+    except SystemExit, e:
+        code = e.code
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    output = open(path).read()
+    os.remove(path)
+    return code, output
+
+def test_man_parallel_workers():
+    with settings(verbosity=1):
+        for mode in ['process','thread']:
+            code, output = _run_parallel(parallel_mode=mode)
+            #each host's output is prefixed with the host
+            for host in HOSTS: assert '[%s] handled'% host in output
+            #a failing host fails the command
+            assert code == 1
+            assert ' * ok.example.com ok' in output and ' * fail.example.com FAILED (exit code 2)' in output
+
+def test_man_rolling_waves():
+    hosts = ['host%s.example.com'% i for i in range(5)]
+    with settings(verbosity=0):
+        command = RollingCommand()
+        command._run_hosts_rolling(hosts, 2, 2, parallel_mode='thread')
+        #every host runs in waves of at most 2
+        assert command.most_running == 2
+        assert [set(command.handled[i:i+2]) for i in (0,2,4)] == [set(hosts[i:i+2]) for i in (0,2,4)]
+        assert env.unavailable_slots is None
+        #a failure in the second wave stops the rollout before the third
+        command = RollingCommand(fail=hosts[2])
+        try:
+            command._run_hosts_rolling(hosts, 2, 2, parallel_mode='thread')
+            assert False
+        except SystemExit, e:
+            assert e.code == 1
+        assert sorted(command.handled) == hosts[:4]
+
+def test_man_unavailable_slots():
+    hosts = ['host%s.example.com'% i for i in range(4)]
+    with settings(verbosity=0):
+        command = RollingCommand()
+        command._run_hosts_rolling(hosts, 4, 1, parallel_mode='thread')
+        #the whole wave runs at once but only one host at a time is unavailable
+        assert sorted(command.handled) == hosts
+        assert command.most_running > 1 and command.most_unavailable == 1
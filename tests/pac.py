@@ -0,0 +1,30 @@
+from fabric.api import sudo, settings
+
+from woven.packages import compare_versions, parse_package, package_diff, package_inventory
+from woven.packages import package_installed, package_version, forget_packages
+
+H = '192.168.188.10'
+HS = 'root@192.168.188.10:22'
+R = 'root'
+
+def test_pac_compare_versions():
+    assert parse_package('nginx>=0.7') == ('nginx','>=','0.7')
+    assert parse_package('nginx') == ('nginx','','')
+    assert compare_versions('0.7.65-1ubuntu2','0.7.65-1') > 0
+    assert compare_versions('1.0~rc1','1.0') < 0
+    assert compare_versions('1:0.9','2.0') > 0
+    assert compare_versions('1.10','1.9') > 0
+
+def test_pac_package_inventory():
+    with settings(hosts=[H],host_string=HS,user=R,password=R):
+        forget_packages()
+        inventory = package_inventory()
+        assert inventory['bash'].status == 'install ok installed'
+        #kept for the run
+        assert package_inventory() is inventory
+        version = package_version('bash')
+        missing, outdated = package_diff(['bash>=%s'% version,'bash>>%s'% version,'woven-no-such-package'])
+        assert missing == ['woven-no-such-package']
+        assert outdated == ['bash>>%s'% version]
+        assert not package_installed('woven-no-such-package')
+        forget_packages()
@@ -0,0 +1,66 @@
+"""
+Tests the scheduler.py module
+"""
+import time
+
+from fabric.api import settings, run
+from fabric.state import env
+
+from woven.environment import begin_state_journal, flush_state_journal, server_state, set_server_state
+
+from woven.scheduler import critical_path, run_tasks
+
+H = '192.168.188.10'
+HS = 'root@192.168.188.10:22'
+R = 'root'
+
+def test_sch_run_tasks():
+    order = []
+    def first():
+        run('sleep 1')
+        order.append('first')
+        return 'first'
+    def second():
+        order.append('second')
+    def third():
+        run('sleep 1')
+        order.append('third')
+    tasks = [(first,[]),(second,[first]),(third,[])]
+    
+    with settings(host=H,host_string=HS,user=R,password=R):
+        #one worker runs tasks in the order given
+        results = run_tasks(tasks, workers=1)
+        assert order == ['first','second','third']
+        assert results['first'] == 'first'
+        
+        #more workers only wait for required tasks
+        del order[:]
+        start = time.time()
+        run_tasks(tasks, workers=3)
+        assert time.time() - start < 2
+        assert order.index('second') > order.index('first')
+
+def test_sch_run_tasks_state_journal():
+    def first():
+        set_server_state('woven-sch-first')
+    def second():
+        set_server_state('woven-sch-second')
+    with settings(host=H,host_string=HS,user=R,password=R):
+        #outside a command the tasks still write to the host's state journal
+        begin_state_journal()
+        run_tasks([(first,[]),(second,[])], workers=2)
+        assert len(env.state_journals[HS]) == 2
+        flush_state_journal(end=True)
+        assert server_state('woven-sch-first') and server_state('woven-sch-second')
+        set_server_state('woven-sch-first',delete=True)
+        set_server_state('woven-sch-second',delete=True)
+
+def test_sch_critical_path():
+    def a(): pass
+    def b(): pass
+    def c(): pass
+    tasks = [(a,[]),(b,[a]),(c,[])]
+    path = critical_path(tasks,{'a':(0,2),'b':(2,3),'c':(0,4)})
+    assert [n for n, d in path] == ['c']
+    path = critical_path(tasks,{'a':(0,2),'b':(2,5),'c':(0,4)})
+    assert [n for n, d in path] == ['a','b']
@@ -0,0 +1,33 @@
+from fabric.api import run, sudo, settings
+
+import os, tempfile
+from hashlib import sha1
+
+from woven.transfer import _chunk_hashes, put_file
+
+H = '192.168.188.10'
+HS = 'root@192.168.188.10:22'
+R = 'root'
+
+def test_tra_put_file():
+    fd, local_path = tempfile.mkstemp()
+    os.write(fd, os.urandom(300000))
+    os.close(fd)
+    with settings(hosts=[H],host_string=HS,user=R,password=R,
+                  LARGE_FILE_THRESHOLD=100000,LARGE_FILE_CHUNK_SIZE=65536):
+        run('rm -rf ~/.staging/put-*')
+        #an interrupted send leaves a half written chunk behind
+        chunk_dir = '~/.staging/put-%s'% sha1(''.join(_chunk_hashes(local_path,65536))).hexdigest()[:16]
+        run('mkdir -p %s && echo half > %s/000001.part'% (chunk_dir,chunk_dir))
+        put_file(local_path,'/tmp/woven-large')
+        assert run('sha1sum /tmp/woven-large').split()[0] == _sha1(local_path)
+        #the chunks are removed once the file is in place
+        assert not run('ls -d ~/.staging/put-* 2>/dev/null; true')
+        #a relative path is relative to the home directory as with put
+        put_file(local_path,'woven-large')
+        assert run('sha1sum woven-large').split()[0] == _sha1(local_path)
+        sudo('rm -f /tmp/woven-large woven-large')
+    os.remove(local_path)
+
+def _sha1(path):
+    return sha1(open(path,'rb').read()).hexdigest()
@@ -1,6 +1,6 @@
 from fabric.api import *
 
-from woven.webservers import _site_users
+from woven.webservers import _site_users, health_check
 from woven.linux import add_user
 
 def test_web_site_users():
@@ -12,4 +12,10 @@ def test_web_site_users():
         add_user(username='site_1',group='www-data',site_user=True)
         users = _site_users()
         assert users[0] == 'site_1'
-        
\ No newline at end of file
+
+def test_web_health_check():
+    with settings(host='192.168.188.10',host_string='root@192.168.188.10:22', user='root',password='root'):
+        #no url means there is nothing to check
+        assert health_check()
+        #nothing listens on this port
+        assert not health_check('http://192.168.188.10:10999/', timeout=0)
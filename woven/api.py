@@ -6,28 +6,35 @@ from fabric.state import env
 
 from woven.decorators import run_once_per_node, run_once_per_version
 
-from woven.deployment import deploy_files, mkdirs
-from woven.deployment import upload_template
+from woven.deployment import batch, deploy_files, mkdirs
+from woven.deployment import upload_template, upload_templates
 
 from woven.environment import check_settings, deployment_root, set_env, patch_project
 from woven.environment import get_project_version, server_state, set_server_state
 from woven.environment import set_version_state, version_state, get_packages
 from woven.environment import post_install_package, post_exec_hook
+from woven.environment import begin_state_journal, flush_state_journal, state_store, compact_state
 
 from woven.project import deploy_static, deploy_media, deploy_project, deploy_db, deploy_templates
 
+from woven.scheduler import run_tasks
+
 from woven.linux import add_user, install_package, port_is_open, skip_disable_root
 from woven.linux import install_packages, uninstall_packages
 from woven.linux import upgrade_packages, setup_ufw, setup_ufw_rules, disable_root
 from woven.linux import add_repositories, restrict_ssh, upload_ssh_key
 from woven.linux import change_ssh_port, set_timezone, lsb_release, upload_etc
 
+from woven.packages import package_inventory, package_diff, package_installed, package_version
+
+from woven.facts import host_facts, forget_facts
+
 from woven.virtualenv import activate, active_version
 from woven.virtualenv import mkvirtualenv, rmvirtualenv, pip_install_requirements
 
 
 from woven.webservers import deploy_wsgi, deploy_webconf, start_webserver, stop_webserver, reload_webservers
-from woven.webservers import webserver_list
+from woven.webservers import webserver_list, health_check
 
 def deploy(overwrite=False):
     """
@@ -35,11 +42,24 @@ def deploy(overwrite=False):
     """
     check_settings()
     if overwrite:
+        #send every file again rather than only those changed since the last deploy
+        env.overwrite = True
         rmvirtualenv()
-    deploy_funcs = [deploy_project,deploy_templates, deploy_static, deploy_media,  deploy_webconf, deploy_wsgi]
+    #each step and the steps it requires
+    deploy_tasks = [(deploy_project,[mkvirtualenv]),
+                    (deploy_templates,[mkvirtualenv]),
+                    (deploy_static,[mkvirtualenv]),
+                    (deploy_media,[]),
+                    (deploy_webconf,[deploy_project,pip_install_requirements]),
+                    (deploy_wsgi,[deploy_project,pip_install_requirements])]
     if not patch_project() or overwrite:
-        deploy_funcs = [deploy_db,mkvirtualenv,pip_install_requirements] + deploy_funcs
-    for func in deploy_funcs: func()
+        deploy_tasks = [(deploy_db,[]),
+                        (mkvirtualenv,[]),
+                        (pip_install_requirements,[mkvirtualenv])] + deploy_tasks
+    def after(func):
+        #checkpoint buffered state after the slowest step
+        if func == pip_install_requirements: flush_state_journal()
+    run_tasks(deploy_tasks, after=after)
 
 
 def setupnode(overwrite=False):
@@ -63,6 +83,8 @@ def setupnode(overwrite=False):
     setup_ufw()
     uninstall_packages()
     install_packages()
+    #checkpoint buffered state after the slowest steps
+    flush_state_journal()
 
     upload_etc()
     post_install_package()
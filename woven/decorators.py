@@ -4,59 +4,69 @@ from fabric.api import env
 from woven.environment import server_state, set_server_state
 from woven.environment import version_state, set_version_state
 
-def run_once_per_node(func):
+def _run_once(func, fingerprint=None):
     """
-    Decorator preventing wrapped function from running more than
-    once per host (not just interpreter session).
+    Wraps ``func`` so that it only runs once per host and env.project_fullname.
 
-    Using env.patch = True will allow the wrapped function to be run
-    if it has been previously executed, but not otherwise
-    
-    Stores the result of a function as server state
+    ``fingerprint`` is an optional function returning a hash of the inputs to ``func``.
+    It is stored alongside the function's state, and when patching the function is
+    skipped if the inputs haven't changed since it last ran.
     """
+    fingerprint_name = '.'.join([func.__name__,'fingerprint'])
     @wraps(func)
     def decorated(*args, **kwargs):
         if not hasattr(env,'patch'): env.patch = False
         state = version_state(func.__name__)
+        current = None
+        #only fingerprint when the function may run, and only once since it can be expensive
+        if fingerprint and bool(env.patch) == bool(state): current = fingerprint()
         if not env.patch and state:
             verbose = " ".join([env.host,func.__name__,"completed. Skipping..."])
         elif env.patch and not state:
             verbose = " ".join([env.host,func.__name__,"not previously completed. Skipping..."])
+        elif env.patch and current and version_state(fingerprint_name) == current:
+            verbose = " ".join([env.host,func.__name__,"unchanged. Skipping..."])
         else:
             results = func(*args, **kwargs)
             verbose =''
             if results: set_version_state(func.__name__,object=results)
             else: set_version_state(func.__name__)
+            if current: set_version_state(fingerprint_name,object=current)
             return results
         if env.verbosity and verbose: print verbose
-        return             
-          
+        return
+
     return decorated
 
-def run_once_per_version(func):
+def run_once_per_node(func=None, fingerprint=None):
+    """
+    Decorator preventing wrapped function from running more than
+    once per host (not just interpreter session).
+
+    Using env.patch = True will allow the wrapped function to be run
+    if it has been previously executed, but not otherwise
+
+    Stores the result of a function as server state
+
+    Can be used with a ``fingerprint`` function eg @run_once_per_node(fingerprint=func)
+    to skip patching when the function's inputs haven't changed
+    """
+    if func is None:
+        return lambda f: _run_once(f, fingerprint)
+    return _run_once(func, fingerprint)
+
+def run_once_per_version(func=None, fingerprint=None):
     """
     Decorator preventing wrapped function from running more than
     once per host and env.project_fullname (not just interpreter session).
 
     Using env.patch = True will allow the function to be run
-    
+
     Stores the result of a function as server state
+
+    Can be used with a ``fingerprint`` function eg @run_once_per_version(fingerprint=func)
+    to skip patching when the function's inputs haven't changed
     """
-    @wraps(func)
-    def decorated(*args, **kwargs):
-        if not hasattr(env,'patch'): env.patch = False
-        state = version_state(func.__name__)
-        if not env.patch and state:
-            verbose = " ".join([env.host,func.__name__,"completed. Skipping..."])
-        elif env.patch and not state:
-            verbose = " ".join([env.host,func.__name__,"not previously completed. Skipping..."])
-        else:
-            results = func(*args, **kwargs)
-            verbose =''
-            if results: set_version_state(func.__name__,object=results)
-            else: set_version_state(func.__name__)
-            return results
-        if env.verbosity and verbose: print verbose
-        return             
-          
-    return decorated
\ No newline at end of file
+    if func is None:
+        return lambda f: _run_once(f, fingerprint)
+    return _run_once(func, fingerprint)
@@ -1,16 +1,22 @@
 #!/usr/bin/env python
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+from fnmatch import fnmatch
 from functools import wraps
-from glob import glob
 from hashlib import sha1
-import os, shutil, sys, tempfile
+import atexit, base64, json, os, re, shutil, subprocess, sys, tempfile, threading
 
-from django.template.loader import render_to_string
+from django.template import Context
+from django.template.loader import get_template
 
 from fabric.state import env
-from fabric.operations import run, sudo, put
+from fabric.operations import local, run, sudo, put
 from fabric.context_managers import cd, settings, hide
-from fabric.contrib.files import exists
-from fabric.contrib.project import rsync_project
+
+from woven.environment import deployment_root, server_state, set_server_state
+from woven.environment import version_state, set_version_state
+from woven.files import exists, forget
+from woven.transfer import put_file
 
 def _backup_file(path):
     """
@@ -22,6 +28,7 @@ def _backup_file(path):
         directory = ''.join([backup_base,os.path.split(path)[0]])
         sudo('mkdir -p %s'% directory)
         sudo('cp %s %s'% (path,backup_path))
+        forget(backup_path)
 
 def _restore_file(path, delete_backup=True):
     """
@@ -34,63 +41,402 @@ def _restore_file(path, delete_backup=True):
             sudo('mv -f %s %s'% (backup_path,path))
         else:
             sudo('cp -f %s %s'% (backup_path,path))
+        forget(backup_path)
+        forget(path)
+
 
+def _pattern_regex(pattern):
+    """
+    Translates a glob ``pattern`` relative to a directory into a regular expression.
+    As in the shell * and ? don't match a / but **/ matches any number of directories
+    """
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern[i:i+3] == '**/':
+            regex += '(?:.*/)?'; i += 3
+        elif pattern[i:i+2] == '**':
+            regex += '.*'; i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'; i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'; i += 1
+        elif pattern[i] == '[' and ']' in pattern[i+2:]:
+            end = pattern.index(']',i+2)
+            chars = pattern[i+1:end]
+            if chars[0] == '!': chars = '^'+chars[1:]
+            regex += '[%s]'% chars.replace('\\','\\\\'); i = end+1
+        else:
+            regex += re.escape(pattern[i]); i += 1
+    return re.compile(regex+'$')
 
-def _get_local_files(local_dir, pattern=''):
+def _get_local_files(local_dir, pattern='', exclude=()):
     """
     Returns a dictionary with directories as keys, and filenames as values
     for filenames matching the glob ``pattern`` under the ``local_dir``
     ``pattern can contain the Boolean OR | to evaluated multiple patterns into
     a combined set. 
+
+    ** matches any number of directories eg 'static/**/*.css', and all the files
+    under a matching directory are included. Files and directories matching an rsync
+    style ``exclude`` pattern are left out.
     """
     local_files = {}
     
     if pattern:
-        cwd = os.getcwd()
-        os.chdir(local_dir)
-        patterns = pattern.split('|')
-        local_list = set([])
-        for p in patterns: local_list = local_list | set(glob(p))
-        for path in local_list:
-            dir, file = os.path.split(path)
-            if os.path.isfile(path):
-                local_files[dir] = local_files.get(dir,[])+[file]
-            elif os.path.isdir(path):
-                local_files[file] = local_files.get(dir,[])
-        os.chdir(cwd)
+        patterns = [p for p in pattern.split('|') if p]
+        regexes = [_pattern_regex(p) for p in patterns]
+        #don't walk any deeper than the patterns can match
+        depth = max([p.count('/') for p in patterns])
+        if [p for p in patterns if '**' in p]: depth = None
+        included = set([])
+        for root, dirs, files in os.walk(local_dir):
+            relative_root = os.path.relpath(root, local_dir)
+            if relative_root == '.': relative_root = ''
+            subdirs = []
+            for d in sorted(dirs):
+                path = os.path.join(relative_root,d)
+                if _excluded(path, exclude): continue
+                if relative_root in included or [r for r in regexes if r.match(path)]:
+                    included.add(path)
+                elif depth is not None and path.count('/') >= depth: continue
+                subdirs.append(d)
+            dirs[:] = subdirs
+            for file in sorted(files):
+                path = os.path.join(relative_root,file)
+                if _excluded(path, exclude): continue
+                if relative_root in included or [r for r in regexes if r.match(path)]:
+                    local_files[relative_root] = local_files.get(relative_root,[])+[file]
     return local_files
 
-def _stage_local_files(local_dir, local_files={}):
+def _excluded(path, exclude):
+    """
+    True if the relative ``path`` matches any rsync style ``exclude`` pattern.
+    A leading / anchors the pattern to the root of the tree.
+    """
+    name = os.path.basename(path)
+    for pattern in exclude:
+        if pattern[0] == '/':
+            if fnmatch(path, pattern[1:]): return True
+        elif fnmatch(name, pattern):
+            return True
+    return False
+
+def fingerprint_tree(local_dir, exclude=['*.pyc','.*'], extra=''):
+    """
+    Returns a sha1 fingerprint of the tree at ``local_dir`` made from the relative path,
+    size and modification time of every file not matching an ``exclude`` pattern.
+
+    ``extra`` is any other input to be included in the fingerprint.
+    """
+    fingerprint = sha1(extra)
+    if not os.path.exists(local_dir): return fingerprint.hexdigest()
+    for root, dirs, files in os.walk(local_dir):
+        relative_root = os.path.relpath(root, local_dir)
+        if relative_root == '.': relative_root = ''
+        dirs[:] = sorted([d for d in dirs if not _excluded(os.path.join(relative_root,d),exclude)])
+        for file in sorted(files):
+            path = os.path.join(relative_root,file)
+            if _excluded(path, exclude): continue
+            stat = os.stat(os.path.join(root,file))
+            fingerprint.update('%s %s %s\n'% (path, stat.st_size, int(stat.st_mtime)))
+    return fingerprint.hexdigest()
+
+def _local_tree(local_dir, exclude=['*.pyc','.*']):
+    """
+    Returns a dictionary of every directory under ``local_dir`` and the filenames in it
+    that don't match an rsync style ``exclude`` pattern
+    """
+    local_files = {}
+    for root, dirs, files in os.walk(local_dir):
+        relative_root = os.path.relpath(root, local_dir)
+        if relative_root == '.': relative_root = ''
+        dirs[:] = [d for d in dirs if not _excluded(os.path.join(relative_root,d),exclude)]
+        local_files[relative_root] = [f for f in files if not _excluded(os.path.join(relative_root,f),exclude)]
+    return local_files
+
+#Content hashes of local files are cached by path, size and mtime so that
+#a manifest only reads the files that have changed since the last deploy
+_manifest_cache_lock = threading.Lock()
+
+def _manifest_cache_path(local_dir):
+    return os.path.join(os.getcwd(),'.woven','manifests',sha1(local_dir).hexdigest()[:12]+'.json')
+
+def local_manifest(local_dir, local_files=None, exclude=['*.pyc','.*']):
+    """
+    Returns a manifest of the files under ``local_dir`` that would be deployed,
+    as a dictionary of relative paths to [size, sha1]
+
+    ``local_files`` is an optional dictionary of directories and filenames
+    as returned by ``_get_local_files``, otherwise all the files not matching
+    an ``exclude`` pattern are included.
+    """
+    if local_files is None: local_files = _local_tree(local_dir, exclude)
+    cache_path = _manifest_cache_path(local_dir)
+    with _manifest_cache_lock:
+        try:
+            cache = json.load(open(cache_path))
+        except (IOError, ValueError):
+            cache = {}
+        manifest = {}
+        changed = False
+        for relative_root, files in local_files.items():
+            for file in files:
+                path = os.path.join(relative_root,file)
+                stat = os.stat(os.path.join(local_dir,path))
+                size, mtime = stat.st_size, int(stat.st_mtime)
+                cached = cache.get(path)
+                if not cached or cached[0] <> size or cached[1] <> mtime:
+                    content = sha1()
+                    f = open(os.path.join(local_dir,path),'rb')
+                    for chunk in iter(lambda: f.read(65536), ''): content.update(chunk)
+                    f.close()
+                    cached = cache[path] = [size, mtime, content.hexdigest()]
+                    changed = True
+                manifest[path] = [size, cached[2]]
+        if changed:
+            if not os.path.exists(os.path.dirname(cache_path)): os.makedirs(os.path.dirname(cache_path))
+            #write then rename so concurrent deploys never read a partial cache
+            tmp_path = '.'.join([cache_path,str(os.getpid())])
+            json.dump(cache,open(tmp_path,'w'))
+            os.rename(tmp_path,cache_path)
+    return manifest
+
+def _manifest_changes(manifest, deployed):
+    """
+    Returns a dictionary of directories and filenames in ``manifest`` which
+    are new or different from the ``deployed`` manifest
+    """
+    changes = {}
+    for path, entry in manifest.items():
+        if deployed.get(path) == entry: continue
+        dir, file = os.path.split(path)
+        changes[dir] = changes.get(dir,[])+[file]
+    return changes
+
+def _manifest_digest(manifest):
+    return sha1(json.dumps(manifest, sort_keys=True)).hexdigest()
+
+def _read_manifest(manifest_path, digest, use_sudo=False):
+    """
+    Returns the manifest at ``manifest_path`` on the host, or None if it is
+    missing or doesn't match ``digest``
+    """
+    func = use_sudo and sudo or run
+    with settings(hide('running','stdout','warnings'),warn_only=True):
+        output = func('cat %s'% manifest_path)
+    if output.failed: return None
+    try:
+        manifest = json.loads(output)
+    except ValueError:
+        return None
+    if not isinstance(manifest, dict) or _manifest_digest(manifest) <> digest: return None
+    return manifest
+
+def _write_manifest(manifest, manifest_path, use_sudo=False):
+    """
+    Uploads ``manifest`` to ``manifest_path`` on the host
+    """
+    fd, local_path = tempfile.mkstemp(suffix='.json')
+    try:
+        os.write(fd, json.dumps(manifest, sort_keys=True))
+        os.close(fd)
+        with settings(hide('running','stdout')):
+            put_file(local_path, manifest_path, use_sudo)
+    finally:
+        os.remove(local_path)
+
+def _stage_local_files(local_dir, local_files=None):
     """
     Either ``local_files`` and/or ``context`` should be supplied.
     
     Will stage a ``local_files`` dictionary of path:filename pairs where path
     is relative to ``local_dir`` into a local tmp staging directory.
+
+    Files are hard linked into the staging directory where possible rather than copied.
     
     Returns a path to the temporary local staging directory
 
     """
     staging_dir = os.path.join(tempfile.mkdtemp(),os.path.basename(local_dir))
     os.mkdir(staging_dir)
-    for root, dirs, files in os.walk(local_dir):
-        relative_tree = root.replace(local_dir,'')
-        if relative_tree:
-            relative_tree = relative_tree[1:]
-        if local_files:
-            files = local_files.get(relative_tree,[])
+    if local_files is None:
+        local_files = {}
+        for root, dirs, files in os.walk(local_dir):
+            relative_tree = os.path.relpath(root, local_dir)
+            if relative_tree == '.': relative_tree = ''
+            local_files[relative_tree] = files
+    for relative_tree, files in local_files.items():
+        if relative_tree and not os.path.exists(os.path.join(staging_dir,relative_tree)):
+            os.makedirs(os.path.join(staging_dir,relative_tree))
         for file in files:
-            if relative_tree:
-                filepath = os.path.join(relative_tree,file)
-                if not os.path.exists(os.path.join(staging_dir,relative_tree)):
-                    os.mkdir(os.path.join(staging_dir,relative_tree))
-            else: filepath = file
-            shutil.copy2(os.path.join(root,file),os.path.join(staging_dir,filepath))
+            filepath = os.path.join(relative_tree,file)
+            try:
+                os.link(os.path.join(local_dir,filepath),os.path.join(staging_dir,filepath))
+            except OSError:
+                #across filesystems or where links aren't supported
+                shutil.copy2(os.path.join(local_dir,filepath),os.path.join(staging_dir,filepath))
     return staging_dir
 
+def _files_from(local_files):
+    """
+    Writes the relative paths in a ``local_files`` dictionary to a temporary file
+    for rsync --files-from and returns its path
+    """
+    fd, path = tempfile.mkstemp(prefix='woven-files-')
+    list_file = os.fdopen(fd,'w')
+    for relative_tree in sorted(local_files):
+        for file in local_files[relative_tree]:
+            list_file.write(os.path.join(relative_tree,file)+'\n')
+    list_file.close()
+    return path
+
+#One multiplexed OpenSSH connection per host is shared by every rsync,
+#so only the first transfer to a host pays for the ssh handshake.
+#Commands and put already share fabric's single paramiko connection per host.
+_ssh_masters = {}
+_ssh_masters_lock = threading.Lock()
+
+def _ssh_control_path():
+    #unix socket paths are short so hash the host string
+    name = 'woven-ssh-%s-%s'% (os.getpid(), sha1(env.host_string).hexdigest()[:12])
+    return os.path.join(tempfile.gettempdir(), name)
+
+def _ssh_options():
+    """
+    Returns the ssh command options for the current host
+    """
+    options = ['-p',str(env.port)]
+    key_filenames = env.get('key_filename') or []
+    if isinstance(key_filenames, basestring): key_filenames = [key_filenames]
+    for key_filename in key_filenames: options += ['-i',key_filename]
+    return options
+
+def ssh_master():
+    """
+    Starts a multiplexed ssh connection (an OpenSSH ControlMaster) to the current host
+    if there isn't one already.
+    
+    Returns the ControlPath of the connection or None if it could not be started,
+    in which case ssh connects normally
+    """
+    if not env.get('SSH_MULTIPLEX',True): return None
+    with _ssh_masters_lock:
+        master = _ssh_masters.get(env.host_string)
+        if master is None:
+            control_path = _ssh_control_path()
+            #BatchMode stops ssh prompting for a password we don't have
+            command = ['ssh','-M','-N','-f','-o','ControlPath=%s'% control_path,'-o','BatchMode=yes'] + \
+                      _ssh_options() + ['%s@%s'% (env.user,env.host)]
+            try:
+                started = subprocess.call(command) == 0
+            except OSError:
+                started = False
+            if not started and env.verbosity:
+                print env.host,"WARNING: Could not start a shared ssh connection. Each transfer will connect separately"
+            master = _ssh_masters[env.host_string] = {'control_path':started and control_path, 'uses':0,
+                                                      'user':env.user, 'host':env.host, 'port':env.port}
+        if master['control_path']: master['uses'] += 1
+        return master['control_path']
+
+def close_ssh_master(host_string=None):
+    """
+    Closes the multiplexed ssh connection to ``host_string`` (defaults to the current host)
+    
+    Returns the number of ssh handshakes it saved
+    """
+    host_string = host_string or env.host_string
+    with _ssh_masters_lock:
+        master = _ssh_masters.pop(host_string,None)
+    if not master or not master['control_path']: return 0
+    subprocess.call(['ssh','-O','exit','-o','ControlPath=%s'% master['control_path'],
+                     '-p',str(master['port']),'%s@%s'% (master['user'],master['host'])],
+                    stdout=open(os.devnull,'w'), stderr=subprocess.STDOUT)
+    saved = max(master['uses'] - 1, 0)
+    if env.verbosity and saved:
+        print master['host'],"Shared ssh connection saved %s ssh handshakes"% saved
+    return saved
+
+def _close_ssh_masters():
+    for host_string in _ssh_masters.keys():
+        close_ssh_master(host_string)
+atexit.register(_close_ssh_masters)
+
+def rsync(local_dir, remote_dir, exclude=(), delete=False, extra_opts='', download=False):
+    """
+    Rsync ``local_dir`` to ``remote_dir`` on the current host over the host's
+    shared ssh connection. Takes the same arguments as ``rsync_project``.
+    
+    With ``download`` ``remote_dir`` is copied to ``local_dir`` instead
+    """
+    if not isinstance(exclude, (list, tuple)): exclude = (exclude,)
+    options = ['-pthrvz']
+    if delete: options.append('--delete')
+    options += ['--exclude "%s"'% str(e).replace('"','\\"') for e in exclude]
+    if extra_opts: options.append(extra_opts)
+    rsh = ['ssh'] + _ssh_options()
+    control_path = ssh_master()
+    if control_path: rsh += ['-o','ControlPath=%s'% control_path]
+    options.append('--rsh="%s"'% ' '.join(rsh))
+    remote_dir = '%s@%s:%s'% (env.user,env.host,remote_dir)
+    if download: return local(' '.join(['rsync'] + options + [remote_dir,local_dir]))
+    return local(' '.join(['rsync'] + options + [local_dir,remote_dir]))
+
+
+#Compressors for tar stream transfers in order of preference,
+#with the commands to compress and decompress a stream
+COMPRESSORS = [('zstd','zstd -q -c','zstd -q -dc'),
+               ('lz4','lz4 -q -c','lz4 -q -dc'),
+               ('gzip','gzip -c','gzip -dc'),
+               ('xz','xz -c','xz -dc')]
+
+def _compressor(remote_compressors):
+    """
+    Returns the (name, compress, decompress) commands for env.DEPLOY_COMPRESSION or
+    the first of the ``COMPRESSORS`` available both locally and in ``remote_compressors``
+    """
+    name = env.get('DEPLOY_COMPRESSION')
+    if name == 'none': return ('none','cat','cat')
+    for compressor in COMPRESSORS:
+        if name and compressor[0] <> name: continue
+        if compressor[0] in remote_compressors and find_executable(compressor[0]):
+            return compressor
+    if name:
+        print env.host,"ERROR: DEPLOY_COMPRESSION %s is not available locally and on the host"% name
+        sys.exit(1)
+    return ('none','cat','cat')
+
+def tar_stream(local_dir, remote_dir, local_files, compressor=COMPRESSORS[2]):
+    """
+    Streams the files in the ``local_files`` dictionary from ``local_dir`` as a tar archive,
+    compressed with a ``compressor`` tuple from ``COMPRESSORS``, over the host's
+    shared ssh connection and unpacks it into ``remote_dir``
+    """
+    fd, list_path = tempfile.mkstemp(prefix='woven-tar-')
+    list_file = os.fdopen(fd,'w')
+    for relative_tree in sorted(local_files):
+        #directories are listed so empty ones are created with their permissions
+        if relative_tree: list_file.write(relative_tree+'\n')
+        for file in local_files[relative_tree]:
+            list_file.write(os.path.join(relative_tree,file)+'\n')
+    list_file.close()
+    ssh = ['ssh'] + _ssh_options()
+    control_path = ssh_master()
+    if control_path: ssh += ['-o','ControlPath=%s'% control_path]
+    if env.verbosity:
+        print env.host,"Sending %s as a %s compressed tar stream"% (remote_dir, compressor[0])
+    untar = '"cd %s && %s | tar -xpf -"'% (remote_dir, compressor[2])
+    try:
+        return local(' | '.join([' '.join(['tar -C',local_dir,'--no-recursion -cf - -T',list_path]),
+                                 compressor[1],
+                                 ' '.join(ssh + ['%s@%s'% (env.user,env.host), untar])]))
+    finally:
+        os.remove(list_path)
+
 def deploy_files(local_dir, remote_dir, pattern = '',rsync_exclude=['*.pyc','.*'], use_sudo=False):
     """
     Generic deploy function for cases where one or more files are being deployed to a host.
-    Wraps around ``rsync_project`` and stages files locally and/or remotely
+    Wraps around ``rsync`` and stages files locally and/or remotely
     for network efficiency.
     
     ``local_dir`` is the directory that will be deployed.
@@ -106,7 +452,18 @@ def deploy_files(local_dir, remote_dir, pattern = '',rsync_exclude=['*.pyc','.*'
     ``pattern`` enhances the basic functionality by allowing the python | to include
     multiple patterns. eg '*.txt|Django*'
      
-    ``rsync_exclude`` as per ``rsync_project``
+    ``rsync_exclude`` as per ``rsync``
+
+    A ``remote_dir`` within the version's virtualenv is rsynced into directly, and
+    files that are unchanged from the active version are hard linked to it. If
+    it is new and there is no active version it is sent as a compressed tar stream.
+    Other directories, and all directories when env.DEPLOY_STAGING is set, are
+    rsynced into a remote staging directory and copied from there.
+
+    A manifest of the deployed files is kept in a file beside ``remote_dir`` and
+    its digest as state on the host. Nothing is transferred if the files are unchanged
+    since they were last deployed to ``remote_dir`` and otherwise only the new or
+    modified files are sent, unless env.overwrite is set.
     
     Returns a list of directories and files created on the host.
     
@@ -118,16 +475,59 @@ def deploy_files(local_dir, remote_dir, pattern = '',rsync_exclude=['*.pyc','.*'
     staging_dir = local_dir
     
     #resolve pattern into a dir:filename dict
-    local_files = _get_local_files(local_dir,pattern)
-    #If we are only copying specific files or rendering templates we need to stage locally
-    if local_files: staging_dir = _stage_local_files(local_dir, local_files)
-    remote_staging_dir = '/home/%s/.staging'% env.user
+    local_files = None
+    if pattern: local_files = _get_local_files(local_dir,pattern,rsync_exclude)
+
+    versioned = env.get('project_fullname') and \
+                remote_dir.startswith('/'.join([deployment_root(),'env',env.project_fullname,'']))
+    #the manifest of a versioned directory is removed along with the version's state
+    get_state, set_state = versioned and (version_state, set_version_state) or (server_state, set_server_state)
+    manifest_name = '-'.join(['manifest',sha1(remote_dir+pattern).hexdigest()[:12]])
+    #the state only holds a digest so state snapshots don't grow with the number of files
+    manifest_path = '/'.join([os.path.dirname(remote_dir),'.%s.json'% manifest_name])
+    manifest = local_manifest(local_dir, local_files, rsync_exclude)
+    digest = _manifest_digest(manifest)
+    deployed = not env.get('overwrite') and get_state(manifest_name)
+    if deployed == digest:
+        if env.verbosity: print env.host,"Unchanged",remote_dir,"Skipping..."
+        return created_list
+    #earlier deploys kept the whole manifest as state
+    if isinstance(deployed, basestring): deployed = _read_manifest(manifest_path, deployed, use_sudo)
+    if isinstance(deployed, dict):
+        #only send what has changed since the last deploy
+        local_files = _manifest_changes(manifest, deployed)
+
+    if versioned and not use_sudo and not env.get('DEPLOY_STAGING'):
+        #rsync only sends the files matching the pattern so nothing is staged
+        created_list = _deploy_linked_files(local_dir, remote_dir, rsync_exclude, local_files)
+    else:
+        #If we are only copying specific files we need to stage locally
+        if local_files is not None: staging_dir = _stage_local_files(local_dir, local_files)
+        created_list = _deploy_staged_files(local_dir, staging_dir, remote_dir, pattern, rsync_exclude, use_sudo)
+    _write_manifest(manifest, manifest_path, use_sudo)
+    set_state(manifest_name, object=digest)
+    forget(remote_dir)
+
+    #cleanup any tmp staging dir
+    if staging_dir <> local_dir:
+        shutil.rmtree(staging_dir,ignore_errors=True)
+    
+    return created_list
+
+def _deploy_staged_files(local_dir, staging_dir, remote_dir, pattern, rsync_exclude, use_sudo):
+    """
+    Rsyncs ``staging_dir`` into a remote staging directory then copies it to ``remote_dir``
+    """
+    created_list = []
+    #stage each local_dir and pattern separately so concurrent deploys don't share a staging dir
+    remote_staging_dir = '/home/%s/.staging/%s'% (env.user, sha1(local_dir+pattern).hexdigest()[:8])
     if not exists(remote_staging_dir):
         run(' '.join(['mkdir -pv',remote_staging_dir])).split('\n')
+        forget(remote_staging_dir)
         created_list = [remote_staging_dir]
     
     #upload into remote staging
-    rsync_project(local_dir=staging_dir,remote_dir=remote_staging_dir,exclude=rsync_exclude,delete=True)
+    rsync(local_dir=staging_dir,remote_dir=remote_staging_dir,exclude=rsync_exclude,delete=True)
 
     #create the final destination
     created_dir_list = mkdirs(remote_dir, use_sudo)
@@ -139,11 +539,98 @@ def deploy_files(local_dir, remote_dir, pattern = '',rsync_exclude=['*.pyc','.*'
     remote_base_path = '/'.join([remote_staging_dir,os.path.basename(local_dir),'*'])
     copy_file_list = func(' '.join(['cp -Ruv',remote_base_path,remote_dir])).split('\n')
     if copy_file_list[0]: created_list += [file.split(' ')[2][1:-1] for file in copy_file_list if file]
+    return created_list
 
-    #cleanup any tmp staging dir
-    if staging_dir <> local_dir:
-        shutil.rmtree(staging_dir,ignore_errors=True)
-    
+def _deploy_linked_files(local_dir, remote_dir, rsync_exclude, local_files=None):
+    """
+    Rsyncs the contents of ``local_dir`` straight into ``remote_dir``, hard linking
+    files that are unchanged from the same directory in the active version
+
+    ``local_files`` is an optional dictionary of the files to send as returned
+    by ``_get_local_files``
+    """
+    #the active version is whichever version the project's env symlink points at
+    active_dir = remote_dir.replace('/'.join([deployment_root(),'env',env.project_fullname]),
+                                    '/'.join([deployment_root(),'env',env.project_name]),1)
+    transfer = env.get('DEPLOY_TRANSFER') or 'auto'
+    with batch(fail_fast=False) as b:
+        created_dirs = b.run(' '.join(['mkdir -pv',remote_dir]))
+        link_dest = b.run('readlink -e %s'% active_dir)
+        if transfer <> 'rsync': compressors = b.run(' '.join(['command -v']+[c[0] for c in COMPRESSORS]))
+    if created_dirs.failed:
+        print env.host,"ERROR: Could not create",remote_dir
+        print created_dirs.output
+        sys.exit(1)
+    created_list = _created_dirs(created_dirs.output)
+    if local_files is not None and not local_files: return created_list
+    if not os.listdir(local_dir): return created_list
+
+    new_dir = remote_dir in created_list
+    link_dest = link_dest.succeeded and link_dest.output.strip()
+    if link_dest == remote_dir: link_dest = ''
+    large_files = []
+    #without an active version to delta against, large files are sent in resumable chunks
+    if not link_dest and env.get('LARGE_FILE_THRESHOLD'):
+        if local_files is None: local_files = _local_tree(local_dir, rsync_exclude)
+        large_files = _split_large_files(local_dir, local_files)
+    if large_files and not [f for f in local_files.values() if f]:
+        created_list += _put_large_files(local_dir, remote_dir, large_files)
+        return created_list
+    #with nothing to delta against or link to a tar stream beats rsync's per file overhead
+    if transfer == 'tar' or (transfer == 'auto' and new_dir and not link_dest):
+        remote_compressors = [os.path.basename(c) for c in compressors.output.split('\n') if c]
+        if local_files is None: local_files = _local_tree(local_dir, rsync_exclude)
+        tar_stream(local_dir, remote_dir, local_files, _compressor(remote_compressors))
+        for relative_tree, files in sorted(local_files.items()):
+            if relative_tree: created_list.append('/'.join([remote_dir,relative_tree]))
+            created_list += ['/'.join([remote_dir,relative_tree,file]).replace('//','/') for file in files]
+        created_list += _put_large_files(local_dir, remote_dir, large_files)
+        return created_list
+
+    #itemize every file into a new directory, since those linked to the active version count as created
+    options = ['--out-format="%s %%i %%n"'% Batch.marker]
+    if new_dir: options.append('-ii')
+    if link_dest: options.append('--link-dest=%s'% link_dest)
+    files_from = local_files and _files_from(local_files)
+    if files_from: options.append('--files-from=%s'% files_from)
+    try:
+        output = rsync(local_dir=local_dir+'/',remote_dir=remote_dir+'/',exclude=rsync_exclude,extra_opts=' '.join(options))
+    finally:
+        if files_from: os.remove(files_from)
+    for line in str(output).split('\n'):
+        if not line.startswith(Batch.marker): continue
+        changes, name = line[len(Batch.marker)+1:].split(' ',1)
+        name = name.rstrip('/')
+        if name == '.' or changes[0] not in (new_dir and '>ch.' or '>ch'): continue
+        created_list.append('/'.join([remote_dir,name]))
+    created_list += _put_large_files(local_dir, remote_dir, large_files)
+    return created_list
+
+def _split_large_files(local_dir, local_files):
+    """
+    Removes the files larger than env.LARGE_FILE_THRESHOLD from a ``local_files``
+    dictionary and returns their paths relative to ``local_dir``
+    """
+    large_files = []
+    for relative_tree, files in local_files.items():
+        for file in files[:]:
+            path = os.path.join(relative_tree,file)
+            if os.path.getsize(os.path.join(local_dir,path)) > env.LARGE_FILE_THRESHOLD:
+                files.remove(file)
+                large_files.append(path)
+    return sorted(large_files)
+
+def _put_large_files(local_dir, remote_dir, large_files):
+    """
+    Sends each of the ``large_files`` under ``local_dir`` to ``remote_dir`` with ``put_file``
+    """
+    if not large_files: return []
+    dirs = set(['/'.join([remote_dir,os.path.dirname(path)]).rstrip('/') for path in large_files])
+    run(' '.join(['mkdir -p']+sorted(dirs)))
+    created_list = []
+    for path in large_files:
+        put_file(os.path.join(local_dir,path),'/'.join([remote_dir,path]))
+        created_list.append('/'.join([remote_dir,path]))
     return created_list
 
 def mkdirs(remote_dir, use_sudo=False):
@@ -153,10 +640,177 @@ def mkdirs(remote_dir, use_sudo=False):
     Returns a list of directories created
     """
     func = use_sudo and sudo or run
-    result = func(' '.join(['mkdir -pv',remote_dir])).split('\n')
+    created = _created_dirs(func(' '.join(['mkdir -pv',remote_dir])))
+    forget(remote_dir)
+    return created
+
+def _created_dirs(output):
+    """
+    Returns the list of directories from mkdir -pv ``output``
+    """
     #extract dir list from ["mkdir: created directory `example.com/some/dir'"]
-    if result[0]: result = [dir.split(' ')[3][1:-1] for dir in result if dir]
-    return result
+    return [dir.split(' ')[3][1:-1] for dir in str(output).split('\n') if dir]
+
+class BatchCommand(object):
+    """
+    A command queued in a ``batch``.
+    
+    Once the batch has run ``output`` is the command's combined stdout and stderr
+    and ``return_code`` its exit code, or None if the batch stopped before it ran.
+    """
+    def __init__(self, command, use_sudo=False):
+        self.command = command
+        self.use_sudo = use_sudo
+        self.output = ''
+        self.return_code = None
+
+    @property
+    def failed(self):
+        return self.return_code <> 0
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    def __str__(self):
+        return self.output
+
+    def __repr__(self):
+        return '<BatchCommand %r exit code %s>'% (self.command, self.return_code)
+
+class Batch(object):
+    """
+    Collects ``run`` and ``sudo`` commands and executes them on the current host
+    as a single script in one round trip.
+    
+    With ``fail_fast`` the script stops at the first failing command and, unless
+    env.warn_only is set, woven exits as run or sudo would. Otherwise every command
+    runs and failures are only recorded on the returned commands.
+    """
+    #marks the end of each command's output with its index and exit code
+    marker = '__woven_batch__'
+
+    def __init__(self, fail_fast=True):
+        self.fail_fast = fail_fast
+        self.commands = []
+
+    def _add(self, command, use_sudo):
+        #honour any fabric cd() in effect when the command is added
+        if env.get('cwd'): command = ' && '.join(['cd %s'% env.cwd, command])
+        command = BatchCommand(command, use_sudo)
+        self.commands.append(command)
+        return command
+
+    def run(self, command):
+        """
+        Queue ``command`` to run as the current user. Returns a BatchCommand
+        """
+        return self._add(command, False)
+
+    def sudo(self, command):
+        """
+        Queue ``command`` to run as root. Returns a BatchCommand
+        """
+        return self._add(command, True)
+
+    def script(self, use_sudo):
+        lines = []
+        for i, command in enumerate(self.commands):
+            cmd = command.command
+            #when the script runs as root, run commands as the current user
+            if use_sudo and not command.use_sudo:
+                cmd = "sudo -H -u %s bash -l -c '%s'"% (env.user, cmd.replace("'","'\\''"))
+            lines.append('(%s) 2>&1'% cmd)
+            lines.append('rc=$?; echo "%s %s $rc"'% (self.marker, i))
+            if self.fail_fast: lines.append('[ $rc -eq 0 ] || exit $rc')
+        return '\n'.join(lines)+'\n'
+
+    def execute(self):
+        """
+        Runs the queued commands and returns them with their output and exit codes
+        """
+        if not self.commands: return []
+        use_sudo = bool([c for c in self.commands if c.use_sudo])
+        script = base64.b64encode(self.script(use_sudo))
+        func = use_sudo and sudo or run
+        with settings(warn_only=True):
+            result = func('bash -c "$(echo %s | base64 -d)"'% script)
+        #the commands could have changed anything on the host
+        forget()
+        output = []
+        for line in result.replace('\r','').split('\n'):
+            #output without a trailing newline shares a line with the marker
+            line, marker, end = line.partition(self.marker)
+            if line or not marker: output.append(line)
+            if marker:
+                i, return_code = end.split()
+                command = self.commands[int(i)]
+                command.output = '\n'.join(output)
+                command.return_code = int(return_code)
+                output = []
+        failed = [c for c in self.commands if c.failed]
+        if failed and self.fail_fast and not env.warn_only:
+            print env.host, "ERROR: %s failed with exit code %s"% (failed[0].command, failed[0].return_code)
+            if failed[0].output: print failed[0].output
+            sys.exit(1)
+        return self.commands
+
+@contextmanager
+def batch(fail_fast=True):
+    """
+    Context manager that queues ``run`` and ``sudo`` calls on the yielded Batch
+    and executes them in one round trip on leaving the block.
+    
+    eg::
+    
+        with batch() as b:
+            b.run('mkdir -p %s'% path)
+            b.sudo('chown www-data %s'% path)
+    """
+    commands = Batch(fail_fast)
+    yield commands
+    commands.execute()
+
+#Compiled templates and their rendered output are kept for the rest of the run,
+#since many hosts and domains render the same templates with the same context
+_templates = {}
+_rendered = {}
+_render_stats = {}
+_render_lock = threading.Lock()
+
+def render_template(filename, context={}):
+    """
+    Renders the Django template ``filename`` with the ``context`` dictionary as
+    ``render_to_string`` does, but each template is only loaded and compiled once per run
+    and rendering the same template with an equal context returns the earlier output.
+    Contexts that can't be serialized as json are always rendered.
+    """
+    #the repr of other objects needn't change with their state, so they can't be part of the key
+    try:
+        key = (filename, sha1(json.dumps(context, sort_keys=True)).hexdigest())
+    except (TypeError, ValueError):
+        key = None
+    with _render_lock:
+        stats = _render_stats.setdefault(env.host_string,[0,0])
+        text = key and _rendered.get(key)
+        if text is not None:
+            stats[0] += 1
+            return text
+        stats[1] += 1
+        template = _templates.get(filename)
+    if template is None:
+        template = _templates[filename] = get_template(filename)
+    text = template.render(Context(context))
+    if key:
+        with _render_lock: _rendered[key] = text
+    return text
+
+def render_cache_stats(host_string=None):
+    """
+    Returns the number of (cached, rendered) templates for ``host_string``
+    which defaults to the current host
+    """
+    return tuple(_render_stats.get(host_string or env.host_string,[0,0]))
 
 def upload_template(filename,  destination,  context={},  use_sudo=False, backup=True, modified_only=False):
     """
@@ -177,7 +831,7 @@ def upload_template(filename,  destination,  context={},  use_sudo=False, backup
     """
     #Replaces the default fabric.contrib.files.upload_template
     basename = os.path.basename(filename)
-    text = render_to_string(filename,context)
+    text = render_template(filename,context)
 
     func = use_sudo and sudo or run
     
@@ -189,7 +843,9 @@ def upload_template(filename,  destination,  context={},  use_sudo=False, backup
         hashfile_path = os.path.join(hashfile_dir, hashfile)
         hashed = sha1(text).hexdigest()
         if hashfile:
-            if not exists(hashfile_dir): sudo('mkdir -p %s'% hashfile_dir)
+            if not exists(hashfile_dir):
+                sudo('mkdir -p %s'% hashfile_dir)
+                forget(hashfile_dir)
             sudo('touch %s'% hashfile_path) #store the hash near the template
             previous_hashed = sudo('cat %s'% hashfile_path).strip()
             if previous_hashed == hashed:
@@ -224,4 +880,78 @@ def upload_template(filename,  destination,  context={},  use_sudo=False, backup
             _backup_file(to_backup)
     # Actually move uploaded template to destination
     func("mv %s %s" % (temp_destination, destination))
-    return True
\ No newline at end of file
+    forget(destination)
+    return True
+
+def upload_templates(templates, use_sudo=False, backup=True, modified_only=False, owner=''):
+    """
+    Render and upload many templates to the current host in a few round trips.
+
+    ``templates`` is a list of (filename, destination, context) where ``filename``
+    is the Django template name and ``destination`` the full remote path of the
+    rendered file. An optional fourth item is a chmod mode for the file eg 'ugo+r'.
+
+    Every template is rendered locally and compared with the sha1 of the file on
+    the host, or with the hash recorded at the last upload when ``modified_only``
+    is set. Only changed files are sent, in a single archive, and they are backed
+    up and moved into place in one batch. ``owner`` is an optional user:group
+    for the uploaded files.
+
+    Returns a list of the destinations uploaded
+    """
+    rendered = []
+    for template in templates:
+        filename, destination, context = template[:3]
+        mode = len(template) > 3 and template[3] or ''
+        text = render_template(filename,context)
+        hashfile_path = ''.join(['/var/local/woven-backup',destination,'.hashfile'])
+        rendered.append((destination, text, sha1(text).hexdigest(), hashfile_path, mode))
+    if not rendered: return []
+
+    func = use_sudo and sudo or run
+    #the hash of each destination, or of the last upload for modified_only, in one round trip
+    if modified_only:
+        paths = ' '.join([r[3] for r in rendered])
+        command = 'for f in %s; do [ -f $f ] && echo "$(cat $f) $f"; done; true'% paths
+    else:
+        command = 'sha1sum %s 2>/dev/null; true'% ' '.join([r[0] for r in rendered])
+    with settings(hide('running','stdout')):
+        output = func(command)
+    remote_hashes = {}
+    for line in output.split('\n'):
+        if len(line.split()) == 2:
+            hashed, path = line.split()
+            remote_hashes[path] = hashed
+    changed = [r for r in rendered if remote_hashes.get(modified_only and r[3] or r[0]) <> r[2]]
+    if not changed: return []
+
+    #ship the changed files in one archive named by their position
+    staging_dir = tempfile.mkdtemp()
+    for i, (destination, text, hashed, hashfile_path, mode) in enumerate(changed):
+        open(os.path.join(staging_dir,str(i)),'w').write(text)
+    archive = os.path.join(tempfile.mkdtemp(),'woven-templates.tar.gz')
+    local(' '.join(['tar -C',staging_dir,'-czf',archive,'.']))
+    remote_archive = '/tmp/%s-%s'% (os.path.basename(staging_dir),os.path.basename(archive))
+    put_file(archive,remote_archive)
+    shutil.rmtree(staging_dir,ignore_errors=True)
+    shutil.rmtree(os.path.dirname(archive),ignore_errors=True)
+
+    remote_staging = remote_archive.replace('.tar.gz','')
+    install = Batch()
+    add = use_sudo and install.sudo or install.run
+    add('mkdir -p %s && tar --no-same-owner -xzf %s -C %s'% (remote_staging,remote_archive,remote_staging))
+    for i, (destination, text, hashed, hashfile_path, mode) in enumerate(changed):
+        if backup:
+            #as _backup_file, never overwrite an existing backup
+            backup_path = ''.join(['/var/local/woven-backup',destination])
+            install.sudo('if [ -f %s ] && [ ! -e %s ]; then mkdir -p %s && cp %s %s; fi'%
+                         (destination,backup_path,os.path.dirname(backup_path),destination,backup_path))
+        add('mv %s/%s %s'% (remote_staging,i,destination))
+        if owner: add('chown %s %s'% (owner,destination))
+        if mode: add('chmod %s %s'% (mode,destination))
+        if modified_only:
+            install.sudo('mkdir -p %s && echo %s > %s'% (os.path.dirname(hashfile_path),hashed,hashfile_path))
+    add('rm -rf %s %s'% (remote_staging,remote_archive))
+    install.execute()
+    return [r[0] for r in changed]
+
@@ -1,19 +1,23 @@
 #!/usr/bin/env python
-import json, os, string, sys, tempfile
+import base64, json, os, sqlite3, string, sys, tempfile, threading, time
 from contextlib import nested
+from hashlib import sha1
 from distutils.core import run_setup
 
 from django.utils.importlib import import_module
 
 from fabric.context_managers import settings as fab_settings
 from fabric.context_managers import _setenv, cd
-from fabric.contrib.files import exists, comment, contains, sed, append
 from fabric.decorators import runs_once, hosts
 from fabric.main import find_fabfile
 from fabric.network import normalize
 from fabric.operations import local, run, sudo, prompt, get, put
 from fabric.state import _AttributeDict, env, output
 from fabric.version import get_version
+
+from woven.files import exists, comment, contains, sed, append, forget
+from woven.packages import package_name
+from woven.transfer import put_file
         
 
 woven_env = _AttributeDict({
@@ -23,6 +27,7 @@ woven_env = _AttributeDict({
 'HOST_USER':'', #optional - can be used in place of defining it elsewhere (ie host_string)
 'HOST_PASSWORD':'',#optional
 'SSH_KEY_FILENAME':'',#optional - as per fabric, a path to a key to use in place your local .ssh key 
+'SSH_MULTIPLEX':True, #optional - share one ssh connection per host between rsync transfers
 
 #The first setup task is usually disabling the default root account and changing the ssh port.
 'ROOT_USER':'root', #optional - mostly the default administrative account is root
@@ -58,6 +63,10 @@ woven_env = _AttributeDict({
 
 #define a list of repositories/sources to search for packages
 'LINUX_PACKAGE_REPOSITORIES':[], # eg ppa:bchesneau/gunicorn
+'APT_UPDATE_TTL':86400, #optional - seconds before apt-get update runs again with unchanged sources
+'PACKAGE_CACHE':'', #optional - local directory where .debs and python dists are collected and seeded to hosts
+'FACTS_TTL':3600, #optional - seconds the facts about a host are cached in .woven/facts
+
     
 #Virtualenv/Pip
 'DEPLOYMENT_ROOT':'',
@@ -71,6 +80,25 @@ woven_env = _AttributeDict({
 #Database migrations
 'MANUAL_MIGRATION':False, #optional Manage database migrations manually
 
+#Deployment
+'PARALLEL':1, #optional - number of hosts a management command runs on at the same time
+'PARALLEL_MODE':'process', #optional - run parallel hosts in worker 'process'es or 'thread's
+'DEPLOY_WORKERS':1, #optional - number of independent deploy steps to run at the same time on each host
+'DEPLOY_STAGING':False, #optional - copy versioned files through ~/.staging instead of rsyncing them into place
+'DEPLOY_TRANSFER':'auto', #optional - 'rsync', 'tar' or 'auto' to send a tar stream into new directories
+'DEPLOY_COMPRESSION':'', #optional - compress tar streams with 'zstd', 'lz4', 'gzip', 'xz' or 'none'. Defaults to the fastest available
+'LARGE_FILE_THRESHOLD':16777216, #optional - files larger than this many bytes are sent in verified, resumable chunks
+'LARGE_FILE_CHUNK_SIZE':8388608, #optional
+'LARGE_FILE_CHANNELS':4, #optional - number of chunks of a large file sent at the same time
+'HEALTH_CHECK_URL':'', #optional - a url or path requested after activating a version eg /health/
+'HEALTH_CHECK_TIMEOUT':60, #optional - seconds to wait for the health check to pass
+
+#Server state
+'STATE_SNAPSHOT':True, #optional - read all of /var/local/woven in one round trip and cache it per host
+'STATE_JOURNAL':True, #optional - buffer state writes during a command and flush them at checkpoints
+'STATE_STORE':'remote', #optional - 'remote', 'sqlite' or a dotted path to a state store class
+'STATE_MIRROR_TTL':3600, #optional - seconds before the sqlite state mirror is resynced from a host
+
 })
 
 def _parse_project_version(version=''):
@@ -372,6 +400,8 @@ def set_env(settings=None, setup_dir=''):
     #no role
     packages[''] = env.HOST_BASE_PACKAGES + env.HOST_EXTRA_PACKAGES
     all_packages = set(packages['']) | all_packages
+    #packages may be pinned to versions eg nginx>=1.0
+    all_packages = set([package_name(p) for p in all_packages])
 
     #conveniently add gunicorn ppa
     if 'gunicorn' in all_packages:
@@ -382,9 +412,10 @@ def set_env(settings=None, setup_dir=''):
     
     #sanity check for unwanted combinations in the empty role
     u = set(packages[''])
-    wsgi = u & set(['gunicorn','uwsgi'])
-    if wsgi and 'apache2' in u:
-        u = u - set(['apache2','libapache2-mod-wsgi'])
+    names = set([package_name(p) for p in u])
+    wsgi = names & set(['gunicorn','uwsgi'])
+    if wsgi and 'apache2' in names:
+        u = set([p for p in u if package_name(p) not in ['apache2','libapache2-mod-wsgi']])
 
     #Used to detect certain apps eg South, static_builder
     env.INSTALLED_APPS = project_settings.INSTALLED_APPS
@@ -438,12 +469,16 @@ def set_env(settings=None, setup_dir=''):
     env.shell = '/bin/bash --noprofile -l -c'
     #output.debug = True
 
-def get_packages():
+def get_packages(pinned=False):
     """
     per host list of packages
+    
+    The names of the packages are returned unless ``pinned``, which
+    returns them with any version pins as given in the settings
     """
     packages = env.packages[env.role_lookup[env.host_string]]
-    return packages
+    if pinned: return packages
+    return [package_name(p) for p in packages]
     
 def patch_project():
     return env.patch
@@ -536,6 +571,159 @@ def project_version(full_version):
 
     return _setenv(project_full_version=project_full_version, project_version=v,project_name=name,project_fullname=project_fullname)
 
+#Per host execution contexts. While a DeployContext is active on a thread, fabric's
+#env and output look in the context before the shared dictionaries, and anything
+#written to them only changes the context.
+_local = threading.local()
+#the number of contexts active on any thread
+_active_contexts = [0]
+_active_contexts_lock = threading.Lock()
+
+def current_context():
+    """
+    The DeployContext active on the current thread or None
+    """
+    return getattr(_local,'context',None)
+
+class DeployContext(object):
+    """
+    Everything woven knows about a host while a command runs on it.
+
+    Use as a context manager to make it the current context for the thread.
+    Host settings, caches such as ``sites`` and ``domains``, and server state
+    snapshots and journals are then kept per host, so hosts can run on
+    separate threads in one process and nothing leaks from one host to the next.
+
+    A context with a ``parent`` sees everything in the parent, but its own
+    writes (eg with ``settings`` or ``cd``) are not seen by the parent.
+    """
+    def __init__(self, host_string=None, parent=None, **kwargs):
+        self.parent = parent
+        self.env = {}
+        self.output = {}
+        if host_string:
+            user, host, port = normalize(host_string)
+            self.env.update(host_string=host_string, host=host, user=user, port=port)
+        if not parent:
+            self.env.update(state_snapshots={}, state_journals={})
+        self.env.update(kwargs)
+        self._previous = []
+
+    def __enter__(self):
+        with _active_contexts_lock:
+            if not _active_contexts[0]:
+                _contextualise(env, 'env')
+                _contextualise(output, 'output')
+            _active_contexts[0] += 1
+        self._previous.append(current_context())
+        _local.context = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.context = self._previous.pop()
+        with _active_contexts_lock:
+            _active_contexts[0] -= 1
+            #env and output are only changed while some context is active
+            if not _active_contexts[0]:
+                _decontextualise(env)
+                _decontextualise(output)
+
+    def layers(self, name):
+        """
+        The ``env`` or ``output`` dictionaries of this context and its parents
+        """
+        context = self
+        while context:
+            yield getattr(context, name)
+            context = context.parent
+
+    def get(self, key, default=None):
+        for layer in self.layers('env'):
+            if key in layer: return layer[key]
+        return dict.get(env, key, default)
+
+    @property
+    def host_string(self):
+        return self.get('host_string')
+
+    @property
+    def host(self):
+        return self.get('host')
+
+    @property
+    def role(self):
+        return self.get('role_lookup',{}).get(self.host_string,'')
+
+    @property
+    def packages(self):
+        return self.get('packages',{}).get(self.role,[])
+
+class _ContextDict(object):
+    """
+    Mixed into fabric's env and output so that the current DeployContext is used first
+    """
+    _context_layer = 'env'
+
+    def _layers(self):
+        context = current_context()
+        if context is None: return []
+        return context.layers(self._context_layer)
+
+    def __getitem__(self, key):
+        for layer in self._layers():
+            if key in layer: return layer[key]
+        return super(_ContextDict, self).__getitem__(key)
+
+    def __setitem__(self, key, value):
+        context = current_context()
+        if context is None: return super(_ContextDict, self).__setitem__(key, value)
+        #fabric output aliases such as 'everything' set each of their groups
+        aliases = self.__dict__.get('aliases') or {}
+        if key in aliases:
+            for aliased in aliases[key]: self[aliased] = value
+        else: getattr(context, self._context_layer)[key] = value
+
+    def __contains__(self, key):
+        for layer in self._layers():
+            if key in layer: return True
+        return super(_ContextDict, self).__contains__(key)
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self: self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def keys(self):
+        keys = set(super(_ContextDict, self).keys())
+        for layer in self._layers(): keys.update(layer.keys())
+        return list(keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+def _contextualise(d, layer):
+    if not isinstance(d, _ContextDict):
+        #fabric's dicts set attributes as keys
+        dict.__setattr__(d, '__class__', type(d.__class__.__name__, (_ContextDict, d.__class__),
+                                              {'_context_layer':layer, '_original_class':d.__class__}))
+
+def _decontextualise(d):
+    if isinstance(d, _ContextDict):
+        dict.__setattr__(d, '__class__', d._original_class)
+
 class State(str):
     """
     State class     
@@ -564,6 +752,502 @@ class State(str):
     def __ne__(self,other):
         return str(self.name) <> other
 
+#Remote python scripts for reading and writing state in one round trip.
+#They must run on the python 2.6 shipped with Ubuntu 10.04
+
+#Replays a committed journal of state writes and keeps the state index.
+#A journal is only ever renamed into /var/local/woven/.journal once it is complete,
+#and replaying it is idempotent, so an interrupted flush is finished by whichever
+#script runs next. The index records the project, version, task, size, mtime and sha1
+#of every state so that lookups never need to glob the state directory.
+STATE_REPLAY_SCRIPT = """
+import hashlib, json, os
+state_dir = '/var/local/woven'
+journal_path = os.path.join(state_dir, '.journal')
+index_path = os.path.join(state_dir, '.index')
+project_name = %(project_name)r
+project_fullname = %(project_fullname)r
+
+def write_file(path, content):
+    tmp_path = os.path.join(state_dir, '.' + os.path.basename(path) + '.tmp')
+    f = open(tmp_path, 'w')
+    f.write(content)
+    f.close()
+    os.rename(tmp_path, path)
+
+def index_entry(name, version=None, task=None, project=None):
+    path = os.path.join(state_dir, name)
+    if version is None:
+        #a state written outside woven. Neither versions nor tasks are free of '-', so it
+        #only belongs to the current version if it is named after it, and a state that
+        #may belong to some other version of this project is never compacted
+        project, version, task = '', '', name
+        if project_fullname and name.startswith(project_fullname + '-'):
+            project, version, task = project_name, project_fullname, name[len(project_fullname) + 1:]
+        elif project_name and name.startswith(project_name + '-'):
+            version = None
+    stat = os.stat(path)
+    return {'project': project, 'version': version, 'task': task, 'size': stat.st_size,
+            'mtime': stat.st_mtime, 'sha1': hashlib.sha1(open(path, 'rb').read()).hexdigest()}
+
+def reconcile(index):
+    for name in list(index.keys()):
+        if not os.path.isfile(os.path.join(state_dir, name)): del index[name]
+    if os.path.isdir(state_dir):
+        for name in os.listdir(state_dir):
+            if name[0] != '.' and name not in index and os.path.isfile(os.path.join(state_dir, name)):
+                index[name] = index_entry(name)
+    return index
+
+def load_index():
+    if os.path.exists(index_path):
+        try:
+            return json.loads(open(index_path).read())
+        except ValueError:
+            pass
+    index = reconcile({})
+    if os.path.isdir(state_dir): write_file(index_path, json.dumps(index))
+    return index
+
+def replay(path):
+    index = load_index()
+    for entry in json.loads(open(path).read()):
+        name = entry['name']
+        state_path = os.path.join(state_dir, name)
+        if entry['delete']:
+            if os.path.exists(state_path): os.remove(state_path)
+            index.pop(name, None)
+            continue
+        if entry['content'] is None:
+            if not os.path.exists(state_path): open(state_path, 'w').close()
+        else:
+            write_file(state_path, entry['content'])
+        index[name] = index_entry(name, entry.get('version'), entry.get('task'), entry.get('project'))
+    write_file(index_path, json.dumps(index))
+    os.remove(path)
+
+if os.path.exists(journal_path): replay(journal_path)
+"""
+
+#%(versions)r lists the versions to read content for, or None for every version
+STATE_SNAPSHOT_SCRIPT = STATE_REPLAY_SCRIPT + """
+versions = %(versions)r
+index = load_index()
+states = {}
+for name, entry in list(index.items()):
+    if versions is None or entry['version'] in versions:
+        try:
+            states[name] = open(os.path.join(state_dir, name)).read()
+        except IOError:
+            del index[name]
+print(json.dumps({'index': index, 'states': states}))
+"""
+
+#%(journal)r is the journal json, or %(journal_file)r an uploaded copy of it
+STATE_FLUSH_SCRIPT = STATE_REPLAY_SCRIPT + """
+journal, journal_file = %(journal)r, %(journal_file)r
+if journal_file:
+    journal = open(journal_file).read()
+    os.remove(journal_file)
+json.loads(journal) #never commit a truncated or corrupt journal
+if not os.path.isdir(state_dir): os.makedirs(state_dir)
+f = open(journal_path + '.new', 'w')
+f.write(journal)
+f.flush()
+os.fsync(f.fileno())
+f.close()
+os.rename(journal_path + '.new', journal_path)
+replay(journal_path)
+"""
+
+#Removes the state of every version of the project whose virtualenv no longer exists
+#in %(env_root)r. Any state files added or removed outside woven are re-indexed first
+STATE_COMPACT_SCRIPT = STATE_REPLAY_SCRIPT + """
+env_root = %(env_root)r
+index = reconcile(load_index())
+removed = []
+for name, entry in list(index.items()):
+    #other projects and deployment roots share the state directory
+    if not entry['version'] or entry.get('project') != project_name: continue
+    if not os.path.isdir(os.path.join(env_root, entry['version'])):
+        os.remove(os.path.join(state_dir, name))
+        del index[name]
+        removed.append(name)
+if os.path.isdir(state_dir): write_file(index_path, json.dumps(index))
+print(json.dumps(removed))
+"""
+
+#Journals larger than this many bytes are uploaded rather than sent inline
+STATE_JOURNAL_INLINE_SIZE = 32768
+
+#Guards the state journals against concurrent deployment tasks
+_state_journal_lock = threading.RLock()
+
+def run_python(script, use_sudo=False):
+    """
+    Run a python ``script`` on the host as a single command.
+
+    The script is base64 encoded to avoid any shell quoting issues
+    """
+    func = use_sudo and sudo or run
+    encoded = base64.b64encode(script)
+    return func("""python -c 'import base64; exec(base64.b64decode("%s"))'"""% encoded)
+
+def _state_script(script, **kwargs):
+    """
+    Fill in a state ``script`` for the current project
+    """
+    kwargs['project_name'] = env.get('project_name','')
+    kwargs['project_fullname'] = env.get('project_fullname','')
+    return script% kwargs
+
+def _state_snapshot():
+    """
+    Returns the state snapshot for the current host, or None if snapshots are
+    disabled or could not be taken.
+    
+    A snapshot is a dictionary with the host's state ``index`` and the content
+    of the current version and server ``states``. It is read in one round trip
+    on the first lookup and cached in ``env.state_snapshots`` for the rest of the run.
+    """
+    if not env.get('STATE_SNAPSHOT',True): return None
+    if not hasattr(env,'state_snapshots'): env.state_snapshots = {}
+    if env.host_string not in env.state_snapshots:
+        env.state_snapshots[env.host_string] = _fetch_states(['',env.get('project_fullname','')])
+    return env.state_snapshots[env.host_string]
+
+def _fetch_states(versions=None):
+    """
+    Read the state index and the content of the states for ``versions``
+    (or every state) on the current host in one round trip.
+    
+    Returns None if the host can't run the snapshot script
+    """
+    with fab_settings(warn_only=True):
+        output = run_python(_state_script(STATE_SNAPSHOT_SCRIPT, versions=versions), use_sudo=True)
+    try:
+        if output.failed: raise ValueError
+        return json.loads(output.split('\n')[-1])
+    except ValueError:
+        #fall back to looking up each state on the host
+        return None
+
+def _update_state_snapshot(entry):
+    """
+    Keep the cached snapshot in step with a state journal ``entry`` written by woven.
+
+    ``content`` of None leaves any existing content as is (ie touch)
+    """
+    snapshot = env.get('state_snapshots',{}).get(env.host_string)
+    if snapshot is None: return
+    name, content = entry['name'], entry['content']
+    if entry['delete']:
+        snapshot['index'].pop(name,None)
+        snapshot['states'].pop(name,None)
+        return
+    if content == None and name in snapshot['index']: return
+    snapshot['states'][name] = content or ''
+    snapshot['index'][name] = {'project':entry['project'], 'version':entry['version'], 'task':entry['task'],
+                               'size':len(content or ''),
+                               'mtime':time.time(), 'sha1':sha1(content or '').hexdigest()}
+
+def begin_state_journal():
+    """
+    Buffer state writes for the current host until ``flush_state_journal``.
+    
+    Buffered states are answered from the state snapshot, so writes are only
+    buffered while a snapshot is available.
+    """
+    if not env.get('STATE_JOURNAL',True): return
+    if not hasattr(env,'state_journals'): env.state_journals = {}
+    env.state_journals.setdefault(env.host_string,[])
+
+def flush_state_journal(end=False):
+    """
+    Write any buffered state for the current host in one atomic operation.
+    
+    ``end`` stops journaling for the host once flushed
+    """
+    journals = env.get('state_journals',{})
+    with _state_journal_lock:
+        entries = journals.get(env.host_string)
+        if end: journals.pop(env.host_string,None)
+        elif entries: journals[env.host_string] = []
+    if entries: _apply_state_journal(entries)
+
+def _apply_state_journal(entries):
+    """
+    Commit a list of state ``entries`` on the host with the flush script
+    """
+    journal = json.dumps(entries)
+    journal_file = ''
+    if len(journal) > STATE_JOURNAL_INLINE_SIZE:
+        fd, file_path = tempfile.mkstemp()
+        f = os.fdopen(fd,'w')
+        f.write(journal)
+        f.close()
+        journal_file = '/tmp/%s'% os.path.basename(file_path)
+        put_file(file_path,journal_file)
+        os.remove(file_path)
+        journal = ''
+    run_python(_state_script(STATE_FLUSH_SCRIPT, journal=journal, journal_file=journal_file), use_sudo=True)
+    forget('/var/local/woven')
+
+def _write_state_file(entry):
+    """
+    Write a state journal ``entry`` straight to its file on the host, as when snapshots
+    are disabled or the host can't run the state scripts. The index is removed so the
+    next snapshot rebuilds it
+    """
+    state_path = '/var/local/woven/%s'% entry['name']
+    if entry['delete']:
+        sudo('rm -f %s /var/local/woven/.index'% state_path)
+    else:
+        sudo('mkdir -p /var/local/woven && touch %s && rm -f /var/local/woven/.index'% state_path)
+        if entry['content'] <> None:
+            fd, file_path = tempfile.mkstemp()
+            f = os.fdopen(fd,'w')
+            f.write(entry['content'])
+            f.close()
+            put_file(file_path,state_path,use_sudo=True)
+            os.remove(file_path)
+    forget('/var/local/woven')
+
+def compact_state():
+    """
+    Remove the state of any version of the project whose virtualenv has been removed
+    from the current host, and re-index the state directory.
+    
+    Returns a list of the state names removed
+    """
+    flush_state_journal()
+    env_root = '/'.join([deployment_root(),'env'])
+    output = run_python(_state_script(STATE_COMPACT_SCRIPT, env_root=env_root), use_sudo=True)
+    clear_state_snapshot()
+    return json.loads(output.split('\n')[-1])
+
+def clear_state_snapshot():
+    """
+    Discard any cached state for the current host.
+
+    Use this after removing state files directly on the host
+    """
+    state_store().invalidate()
+
+class RemoteStateStore(object):
+    """
+    The default state store. State is kept as files in /var/local/woven on each host,
+    read through the state snapshot and written through the state journal.
+    """
+    def get(self, name, full_name, prefix=False, no_content=False):
+        """
+        Returns the parsed json content of ``full_name``, True if it has no content
+        or False if it doesn't exist. ``prefix`` matches any state ending in ``name``
+        """
+        current_state = False
+        state_path = '/var/local/woven/%s'% full_name
+        snapshot = _state_snapshot()
+        if snapshot is not None:
+            index = snapshot['index']
+            if prefix:
+                return bool([s for s in index if s.endswith(name)])
+            elif full_name not in index:
+                return False
+            elif no_content or not index[full_name]['size']:
+                return True
+            if full_name not in snapshot['states']:
+                #state for some other version
+                snapshot['states'][full_name] = sudo('cat %s'% state_path)
+            return json.loads(snapshot['states'][full_name])
+        if not prefix and not no_content and exists(state_path):
+            content = int(sudo('ls -s %s'% state_path).split()[0]) #get size
+            if content:
+                fd, file_path = tempfile.mkstemp()
+                os.close(fd)
+                get(state_path,file_path)
+                with open(file_path, "r") as f:
+                    content = f.read()
+                    object = json.loads(content)
+                    current_state = object
+            else:
+                current_state = True
+        elif not prefix and no_content and exists(state_path):
+            current_state = True
+        elif prefix:
+            with fab_settings(warn_only=True): #find any version
+                current_state = sudo('ls /var/local/woven/*%s'% name)
+            if not current_state.failed:current_state = True
+        return current_state
+
+    def set(self, name, full_name, content=None, delete=False):
+        """
+        Write ``content`` (a json string) to ``full_name`` or delete it.
+        
+        While a state journal is open for the host the write is buffered until the
+        journal is flushed, otherwise it is committed immediately. Without a snapshot
+        the state file is written directly.
+        """
+        entry = {'name':full_name, 'project':env.project_fullname and env.get('project_name',''),
+                 'version':env.project_fullname, 'task':name, 'content':content, 'delete':delete}
+        buffered = _state_snapshot() is not None
+        with _state_journal_lock:
+            journal = env.get('state_journals',{}).get(env.host_string)
+            if journal is not None and buffered: journal.append(entry)
+        if not buffered: _write_state_file(entry)
+        elif journal is None: _apply_state_journal([entry])
+        _update_state_snapshot(entry)
+
+    def states(self, fresh=False):
+        """
+        Returns the state index and the content of every state on the current host
+        as a dictionary with ``index`` and ``states``
+        
+        ``fresh`` reads the host again instead of using the snapshot
+        """
+        snapshot = _state_snapshot()
+        if fresh or snapshot is None or len(snapshot['states']) < len(snapshot['index']):
+            snapshot = _fetch_states()
+            if snapshot is None:
+                print env.host, "ERROR: Could not read the woven state in /var/local/woven"
+                sys.exit(1)
+            if env.get('STATE_SNAPSHOT',True): env.state_snapshots[env.host_string] = snapshot
+        return snapshot
+
+    def invalidate(self):
+        """
+        Forget anything cached about the current host
+        """
+        if hasattr(env,'state_snapshots'):
+            env.state_snapshots.pop(env.host_string,None)
+
+class SQLiteStateStore(RemoteStateStore):
+    """
+    Mirrors host state into a local sqlite database keyed by host and project_fullname.
+    
+    Lookups are answered from the mirror. A host is synced from its state files
+    when it has never been synced or its mirror is older than STATE_MIRROR_TTL seconds.
+    Writes go to the host and the mirror.
+    """
+    def __init__(self, path=''):
+        self.path = path or os.path.join(os.getcwd(),'.woven','state.db')
+        #sqlite connections can't be shared between threads
+        self._local = threading.local()
+
+    def connection(self):
+        if not getattr(self._local,'connection',None):
+            state_dir = os.path.dirname(self.path)
+            if not os.path.exists(state_dir): os.makedirs(state_dir)
+            self._local.connection = sqlite3.connect(self.path)
+            self._local.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS state (
+                    host TEXT, project_fullname TEXT, name TEXT, full_name TEXT, content TEXT,
+                    PRIMARY KEY (host, full_name));
+                CREATE TABLE IF NOT EXISTS synced (host TEXT PRIMARY KEY, synced REAL);
+                """)
+        return self._local.connection
+
+    def is_stale(self):
+        row = self.connection().execute('SELECT synced FROM synced WHERE host=?',
+                                        (env.host_string,)).fetchone()
+        return not row or time.time() - row[0] > env.get('STATE_MIRROR_TTL',3600)
+
+    def sync(self):
+        """
+        Replace the mirror of the current host with the state on the host
+        """
+        states = RemoteStateStore.states(self, fresh=True)
+        db = self.connection()
+        db.execute('DELETE FROM state WHERE host=?', (env.host_string,))
+        for full_name, entry in states['index'].items():
+            db.execute('INSERT INTO state VALUES (?,?,?,?,?)',
+                       (env.host_string, entry['version'], entry['task'], full_name,
+                        states['states'][full_name]))
+        db.execute('INSERT OR REPLACE INTO synced VALUES (?,?)', (env.host_string, time.time()))
+        db.commit()
+        return states
+
+    def verify(self):
+        """
+        Compare the mirror against the host.
+        
+        Returns a dictionary of state names that differ with (mirror, host) content,
+        where None means the state is missing
+        """
+        host_states = RemoteStateStore.states(self, fresh=True)['states']
+        rows = self.connection().execute('SELECT full_name, content FROM state WHERE host=?',
+                                         (env.host_string,)).fetchall()
+        mirror_states = dict(rows)
+        differences = {}
+        for full_name in set(host_states) | set(mirror_states):
+            mirrored = mirror_states.get(full_name)
+            actual = host_states.get(full_name)
+            if mirrored <> actual: differences[full_name] = (mirrored, actual)
+        return differences
+
+    def get(self, name, full_name, prefix=False, no_content=False):
+        if self.is_stale(): self.sync()
+        db = self.connection()
+        if prefix:
+            rows = db.execute('SELECT full_name FROM state WHERE host=?', (env.host_string,)).fetchall()
+            return bool([r for r in rows if r[0].endswith(name)])
+        row = db.execute('SELECT content FROM state WHERE host=? AND full_name=?',
+                         (env.host_string, full_name)).fetchone()
+        if not row: return False
+        if row[0] and not no_content: return json.loads(row[0])
+        return True
+
+    def set(self, name, full_name, content=None, delete=False):
+        RemoteStateStore.set(self, name, full_name, content, delete)
+        db = self.connection()
+        if delete:
+            db.execute('DELETE FROM state WHERE host=? AND full_name=?', (env.host_string, full_name))
+        elif content <> None or not db.execute('SELECT 1 FROM state WHERE host=? AND full_name=?',
+                                                (env.host_string, full_name)).fetchone():
+            db.execute('INSERT OR REPLACE INTO state VALUES (?,?,?,?,?)',
+                       (env.host_string, env.project_fullname, name, full_name, content or ''))
+        db.commit()
+
+    def states(self, fresh=False):
+        if fresh or self.is_stale(): return self.sync()
+        rows = self.connection().execute('SELECT full_name, project_fullname, name, content FROM state WHERE host=?',
+                                         (env.host_string,)).fetchall()
+        index = dict([(r[0], {'version':r[1], 'task':r[2], 'size':len(r[3])}) for r in rows])
+        return {'index':index, 'states':dict([(r[0], r[3]) for r in rows])}
+
+    def invalidate(self):
+        RemoteStateStore.invalidate(self)
+        self.connection().execute('DELETE FROM synced WHERE host=?', (env.host_string,))
+        self.connection().commit()
+
+    def hosts(self, name, project_fullname=''):
+        """
+        Returns the mirrored hosts that have the state ``name`` for ``project_fullname``
+        (or the server state ``name`` if no project_fullname is given) without
+        connecting to any host
+        """
+        rows = self.connection().execute('SELECT host FROM state WHERE name=? AND project_fullname=?',
+                                         (name, project_fullname)).fetchall()
+        return [r[0] for r in rows]
+
+#The state stores available to the STATE_STORE setting
+STATE_STORES = {'remote':RemoteStateStore, 'sqlite':SQLiteStateStore}
+
+def state_store():
+    """
+    Returns the state store defined by the STATE_STORE setting.
+    
+    STATE_STORE can be 'remote', 'sqlite' or a dotted path to a StateStore class
+    """
+    if not hasattr(env,'state_store'):
+        store = env.get('STATE_STORE','remote') or 'remote'
+        if store in STATE_STORES:
+            store_class = STATE_STORES[store]
+        else:
+            module_name, class_name = store.rsplit('.',1)
+            store_class = getattr(import_module(module_name),class_name)
+        env.state_store = store_class()
+    return env.state_store
+
 def set_server_state(name,object=None,delete=False):
     """
     Sets a simple 'state' on the server by creating a file
@@ -580,26 +1264,16 @@ def set_version_state(name,object=None,delete=False):
     Sets a simple 'state' on the server by creating a file
     with the desired state's name + version and storing ``content`` as json strings if supplied
     
+    While a state journal is open for the host the write is buffered until the
+    journal is flushed, otherwise it is committed immediately.
+    
     returns the filename used to store state   
     """
     if env.project_fullname: state_name = '-'.join([env.project_fullname,name])
     else: state_name = name
-    with fab_settings(warn_only=True):
-        #Test for os state
-        if not exists('/var/local/woven', use_sudo=True):
-            sudo('mkdir /var/local/woven')
-    if not delete:
-        sudo('touch /var/local/woven/%s'% state_name)
-        if object <> None:
-            fd, file_path = tempfile.mkstemp()
-            f = os.fdopen(fd,'w')
-            f.write(json.dumps(object))
-            f.close()
-            put(file_path,'/tmp/%s'% state_name)
-            os.remove(file_path)
-            sudo('cp /tmp/%s /var/local/woven/%s'% (state_name,state_name))
-    else:
-        sudo('rm -f /var/local/woven/%s'% state_name)
+    content = None
+    if not delete and object <> None: content = json.dumps(object)
+    state_store().set(name,state_name,content,delete)
     return state_name
     
 
@@ -616,30 +1290,9 @@ def version_state(name, prefix=False, no_content=False):
     """
     If the server state exists return parsed json as a python object or True 
     prefix=True returns True if any files exist with ls [prefix]*
+    
+    Lookups go through the STATE_STORE
     """
     if env.project_fullname: full_name = '-'.join([env.project_fullname,name])
     else: full_name = name
-    current_state = False
-    state = State(full_name)
-    state_path = '/var/local/woven/%s'% full_name
-    if not prefix and not no_content and exists(state_path):
-        content = int(sudo('ls -s %s'% state_path).split()[0]) #get size
-        if content:
-            fd, file_path = tempfile.mkstemp()
-            os.close(fd)
-            get(state_path,file_path)
-            with open(file_path, "r") as f:
-                content = f.read()
-                object = json.loads(content)
-                current_state = object
-        else:
-            current_state = True
-    elif not prefix and no_content and exists(state_path):
-        current_state = True
-    elif prefix:
-        with fab_settings(warn_only=True): #find any version
-            current_state = sudo('ls /var/local/woven/*%s'% name)
-        if not current_state.failed:current_state = True
-      
-    return current_state
-   
+    return state_store().get(name,full_name,prefix,no_content)
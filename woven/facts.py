@@ -0,0 +1,111 @@
+"""
+Facts about the current host, gathered in one round trip.
+
+A python script on the host reports its distribution, cpus, memory, free disk,
+python version, installed webservers and primary ip address as json. The facts
+are kept in memory for the run and in .woven/facts for env.FACTS_TTL seconds,
+so later runs against the same host don't ask again.
+"""
+import json, os, threading, time
+
+from fabric.state import _AttributeDict, env
+from fabric.context_managers import settings, hide
+
+from woven.environment import run_python
+
+FACTS_SCRIPT = r"""
+import json, os, platform, socket, subprocess
+def output(command):
+    try:
+        return subprocess.Popen(command,stdout=subprocess.PIPE,stderr=open(os.devnull,'w')).communicate()[0].decode('utf-8')
+    except OSError:
+        return ''
+facts = {'distributor_id':'','description':'','release':'','codename':''}
+for line in output(['lsb_release','-a']).splitlines():
+    key, sep, value = line.partition(':')
+    if sep: facts[key.strip().replace(' ','_').lower()] = value.strip()
+if os.path.exists('/etc/debian_version'): facts['base'] = 'debian'
+elif os.path.exists('/etc/redhat-release'): facts['base'] = 'redhat'
+else: facts['base'] = 'unknown'
+facts['architecture'] = output(['dpkg','--print-architecture']).strip() or platform.machine()
+facts['cpus'] = os.sysconf('SC_NPROCESSORS_ONLN')
+facts['memory'] = 0
+for line in open('/proc/meminfo'):
+    if line.startswith('MemTotal:'): facts['memory'] = int(line.split()[1])*1024
+disk = os.statvfs(os.path.expanduser('~'))
+facts['disk_free'] = disk.f_bavail*disk.f_frsize
+facts['python_version'] = platform.python_version()
+webservers = output(['dpkg-query','-W','-f=${Package} ${Status}\n','apache2','nginx','gunicorn','uwsgi'])
+facts['webservers'] = sorted([line.split()[0] for line in webservers.splitlines() if line.endswith(' installed')])
+try:
+    #the address of the interface with the default route. udp connect sends nothing
+    s = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    s.connect(('192.0.2.1',9))
+    facts['ip'] = s.getsockname()[0]
+except socket.error:
+    facts['ip'] = (output(['hostname','-I']).split() or [''])[0]
+print(json.dumps(facts))
+"""
+
+#facts that change too often to be used in templates
+VOLATILE_FACTS = ['disk_free']
+
+_facts = {}
+_facts_lock = threading.Lock()
+
+def _facts_cache_path(host_string):
+    return os.path.join(os.getcwd(),'.woven','facts',host_string.replace(':','_')+'.json')
+
+def host_facts(refresh=False):
+    """
+    Returns the facts about the current host as an attribute dictionary with
+    base, distributor_id, description, release, codename, architecture,
+    cpus, memory, disk_free, python_version, webservers and ip.
+
+    Memory and disk_free are in bytes.
+
+    Facts are read from the cache if they are younger than env.FACTS_TTL
+    seconds unless ``refresh``
+    """
+    cache_path = _facts_cache_path(env.host_string)
+    with _facts_lock:
+        facts = _facts.get(env.host_string)
+        if facts is not None and not refresh: return facts
+        facts = None
+        if not refresh and env.get('FACTS_TTL'):
+            try:
+                cached = json.load(open(cache_path))
+                if time.time() - cached['time'] < env.FACTS_TTL: facts = cached['facts']
+            except (IOError, ValueError, KeyError, TypeError):
+                pass
+    if facts is None:
+        with settings(hide('running','stdout')):
+            facts = json.loads(run_python(FACTS_SCRIPT).strip().split('\n')[-1])
+        if env.get('FACTS_TTL'):
+            if not os.path.exists(os.path.dirname(cache_path)): os.makedirs(os.path.dirname(cache_path))
+            #write then rename so concurrent hosts never read a partial cache
+            tmp_path = '.'.join([cache_path,str(os.getpid())])
+            json.dump({'time':time.time(),'facts':facts},open(tmp_path,'w'))
+            os.rename(tmp_path,cache_path)
+    facts = _AttributeDict(facts)
+    with _facts_lock:
+        _facts[env.host_string] = facts
+    return facts
+
+def template_facts():
+    """
+    The facts about the current host that are given to templates as ``facts``
+    """
+    return dict([(k, v) for k, v in host_facts().items() if k not in VOLATILE_FACTS])
+
+def forget_facts(host_string=None):
+    """
+    Discard the facts about ``host_string`` which defaults to the current host
+    """
+    host_string = host_string or env.host_string
+    with _facts_lock:
+        _facts.pop(host_string,None)
+        try:
+            os.remove(_facts_cache_path(host_string))
+        except OSError:
+            pass
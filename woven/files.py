@@ -0,0 +1,153 @@
+"""
+A per host cache of remote file checks.
+
+``exists``, ``contains`` and ``append`` wrap the fabric.contrib.files functions of the
+same name. Results are remembered for the current host for the rest of the run, so
+asking about the same path again costs no round trip. Woven forgets a path when
+it writes to it, including through the ``sed``, ``comment`` and ``uncomment`` wrappers
+here, and ``prefetch`` checks many paths in one command.
+"""
+import threading
+
+from fabric.state import env
+from fabric.operations import run, sudo
+from fabric.context_managers import settings, hide
+from fabric.contrib import files
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def _cache():
+    with _caches_lock:
+        return _caches.setdefault(env.host_string,{'exists':{},'contains':{},'hits':0,'misses':0})
+
+def _hit(cache):
+    with _caches_lock: cache['hits'] += 1
+
+def _miss(cache):
+    with _caches_lock: cache['misses'] += 1
+
+def exists(path, use_sudo=False, verbose=False):
+    """
+    As fabric.contrib.files.exists but cached for the current host
+    """
+    cache = _cache()
+    if path in cache['exists']:
+        _hit(cache)
+        return cache['exists'][path]
+    _miss(cache)
+    result = files.exists(path, use_sudo=use_sudo, verbose=verbose)
+    #without sudo a path may only look missing because a parent directory is unreadable
+    if result or use_sudo: cache['exists'][path] = result
+    return result
+
+def contains(text, filename, exact=False, use_sudo=False):
+    """
+    As fabric.contrib.files.contains but cached for the current host
+    """
+    cache = _cache()
+    key = (filename, text, exact)
+    if key in cache['contains']:
+        _hit(cache)
+        return cache['contains'][key]
+    if cache['exists'].get(filename) is False:
+        _hit(cache)
+        return False
+    _miss(cache)
+    result = bool(files.contains(text, filename, exact=exact, use_sudo=use_sudo))
+    #as with exists, without sudo the file may only be unreadable
+    if result or use_sudo: cache['contains'][key] = result
+    return result
+
+def append(text, filename, use_sudo=False):
+    """
+    As fabric.contrib.files.append but skips lines the cache knows are already in ``filename``
+    """
+    cache = _cache()
+    if isinstance(text, basestring): text = [text]
+    text = [line for line in text if not cache['contains'].get((filename, line, False))]
+    if not text:
+        _hit(cache)
+        return
+    _miss(cache)
+    files.append(text, filename, use_sudo=use_sudo)
+    #other patterns may now match the file
+    forget(filename)
+    cache['exists'][filename] = True
+    for line in text: cache['contains'][(filename, line, False)] = True
+
+def sed(filename, *args, **kwargs):
+    """
+    As fabric.contrib.files.sed, forgetting what is cached about ``filename``
+    """
+    result = files.sed(filename, *args, **kwargs)
+    forget(filename)
+    return result
+
+def comment(filename, *args, **kwargs):
+    """
+    As fabric.contrib.files.comment, forgetting what is cached about ``filename``
+    """
+    result = files.comment(filename, *args, **kwargs)
+    forget(filename)
+    return result
+
+def uncomment(filename, *args, **kwargs):
+    """
+    As fabric.contrib.files.uncomment, forgetting what is cached about ``filename``
+    """
+    result = files.uncomment(filename, *args, **kwargs)
+    forget(filename)
+    return result
+
+def forget(path=None):
+    """
+    Forget what is known about ``path`` and anything under it on the current host,
+    or everything about the host if ``path`` is None
+    """
+    cache = _cache()
+    with _caches_lock:
+        if path is None:
+            cache['exists'].clear()
+            cache['contains'].clear()
+            return
+        path = path.rstrip('/')
+        for p in cache['exists'].keys():
+            if p == path or p.startswith(path+'/'): del cache['exists'][p]
+        for key in cache['contains'].keys():
+            if key[0] == path or key[0].startswith(path+'/'): del cache['contains'][key]
+
+def prefetch(paths, use_sudo=False):
+    """
+    Checks whether each of ``paths`` exists on the current host in one command
+
+    Returns the set of paths that exist. As with ``exists`` a path that is missing
+    is only remembered when checked with ``use_sudo``
+    """
+    cache = _cache()
+    paths = [p for p in paths if p not in cache['exists']]
+    if not paths: return set([p for p, e in cache['exists'].items() if e])
+    func = use_sudo and sudo or run
+    with settings(hide('running','stdout'),warn_only=True):
+        output = func('stat -c %%n %s 2>/dev/null; true'% ' '.join(paths))
+    #lines end in \r\n under a pty
+    existing = set([line.strip() for line in output.splitlines()])
+    _miss(cache)
+    for p in paths:
+        if p in existing or use_sudo: cache['exists'][p] = p in existing
+    return set([p for p, e in cache['exists'].items() if e])
+
+def file_cache_stats(host_string=None):
+    """
+    Returns (round trips saved, round trips made) by the cache for ``host_string``
+    which defaults to the current host
+    """
+    cache = _caches.get(host_string or env.host_string,{'hits':0,'misses':0})
+    return cache['hits'], cache['misses']
+
+def clear_file_cache(host_string=None):
+    """
+    Discard the cache for ``host_string`` which defaults to the current host
+    """
+    with _caches_lock:
+        _caches.pop(host_string or env.host_string,None)
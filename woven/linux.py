@@ -4,7 +4,8 @@ Replaces the ubuntu.py module with more generic linux functions.
 #To implement different backends we'll either
 #split out functions into function and _backend_functions
 #or if the difference is marginal just use if statements
-import os, socket, sys
+import json, os, socket, sys
+from hashlib import sha1
 import getpass
 
 from django.utils import importlib
@@ -12,12 +13,15 @@ from django.utils import importlib
 from fabric.state import  _AttributeDict, env, connections
 from fabric.context_managers import settings, hide
 from fabric.operations import prompt, run, sudo, get, put
-from fabric.contrib.files import comment, uncomment, contains, exists, append, sed
 from fabric.contrib.console import confirm
 from fabric.network import join_host_strings, normalize
 
-from woven.deployment import _backup_file, _restore_file, deploy_files, upload_template
+from woven.deployment import _backup_file, _restore_file, Batch, deploy_files, rsync, upload_template, upload_templates
 from woven.environment import server_state, set_server_state, get_packages
+from woven.facts import forget_facts, host_facts, template_facts
+from woven.files import append, comment, contains, exists, forget, prefetch, sed, uncomment
+from woven.packages import forget_packages, package_diff, package_installed, package_version, parse_package
+from woven.project import _project_template_dir
 
 def _get_template_files(template_dir):
     etc_dir = os.path.join(template_dir,'woven','etc')
@@ -31,6 +35,26 @@ def _get_template_files(template_dir):
 
     return set(templates)
 
+#etc templates are the same for every host so the inventory is built once per run
+_etc_inventory = {}
+
+def _etc_templates():
+    """
+    Returns a dictionary of destination directories and the (template, destination) pairs
+    for the woven and project etc templates that are uploaded to them
+    """
+    project_template_dir = _project_template_dir()
+    if project_template_dir not in _etc_inventory:
+        template_dir = os.path.join(os.path.split(os.path.realpath(__file__))[0],'templates','')
+        etc_templates = _get_template_files(template_dir)
+        if project_template_dir: etc_templates |= _get_template_files(os.path.join(project_template_dir,''))
+        inventory = {}
+        for t in sorted(etc_templates):
+            dest = t.replace('woven','',1)
+            inventory.setdefault(os.path.dirname(dest),[]).append((t,dest))
+        _etc_inventory[project_template_dir] = inventory
+    return _etc_inventory[project_template_dir]
+
 def add_repositories():
     """
     Adds additional sources as defined in LINUX_PACKAGE_REPOSITORIES.
@@ -149,7 +173,9 @@ def disable_root():
         #add user to /etc/sudoers
         if not exists('/etc/sudoers.wovenbak',use_sudo=True):
             sudo('cp -f /etc/sudoers /etc/sudoers.wovenbak')
+            forget('/etc/sudoers.wovenbak')
         sudo('cp -f /etc/sudoers /tmp/sudoers.tmp')
+        forget('/tmp/sudoers.tmp')
         append("# Members of the sudo group may gain root privileges", '/tmp/sudoers.tmp', use_sudo=True)
         append("%sudo ALL=(ALL) ALL", '/tmp/sudoers.tmp', use_sudo=True)
         sudo('visudo -c -f /tmp/sudoers.tmp')
@@ -177,8 +203,85 @@ def install_package(package):
     apt-get install [package]
     """
     #install silent and answer yes by default -qqy
-    sudo('apt-get install -qqy %s'% package, pty=True)
+    sudo('apt-get%s install -qqy %s'% (_apt_options(),package), pty=True)
+    forget_packages()
+    forget_facts()
+
+#where the package cache is kept on each host
+PACKAGE_CACHE_DIR = '/var/cache/woven'
+#local package cache directory of each seeded host
+_package_caches = {}
+
+def _seed_package_cache():
+    """
+    Sends the .debs and python dists in env.PACKAGE_CACHE for the host's release
+    and architecture to PACKAGE_CACHE_DIR on the host, once per run
+    
+    Returns the local directory of the cache or '' if there is no package cache
+    """
+    if not env.get('PACKAGE_CACHE'): return ''
+    if env.host_string in _package_caches: return _package_caches[env.host_string]
+    facts = host_facts()
+    local_dir = os.path.join(os.path.expanduser(env.PACKAGE_CACHE),'-'.join([facts.codename,facts.architecture]))
+    for d in ['debs','python']:
+        if not os.path.exists(os.path.join(local_dir,d)): os.makedirs(os.path.join(local_dir,d))
+    if env.verbosity:
+        print env.host,"SEEDING the package cache from",local_dir
+    #apt downloads into the cache as root but we send to it as the user
+    sudo('mkdir -p %s/debs/partial %s/python && chown -R %s %s'% (PACKAGE_CACHE_DIR,PACKAGE_CACHE_DIR,env.user,PACKAGE_CACHE_DIR))
+    with settings(hide('running')):
+        rsync(local_dir+'/',PACKAGE_CACHE_DIR+'/',exclude=['partial','lock'])
+    _package_caches[env.host_string] = local_dir
+    return local_dir
+
+def _collect_package_cache():
+    """
+    Copies the .debs and python dists the host downloaded back into env.PACKAGE_CACHE
+    so the hosts that follow don't download them again
+    """
+    local_dir = _package_caches.get(env.host_string)
+    if not local_dir: return
+    if env.verbosity:
+        print env.host,"COLLECTING new packages into",local_dir
+    with settings(hide('running')):
+        rsync(local_dir+'/',PACKAGE_CACHE_DIR+'/',exclude=['partial','lock'],download=True)
+
+def _apt_options():
+    #apt installs from the seeded package cache and downloads what is missing into it
+    if not _seed_package_cache(): return ''
+    return ' -o Dir::Cache::Archives=%s/debs/'% PACKAGE_CACHE_DIR
+
+def _apt_argument(package):
+    #apt can only install an exact version, other pins are checked after installing
+    name, operator, version = parse_package(package)
+    if operator in ['=','==']: return '='.join([name,version])
+    return name
+
+def _apt_transaction(command, packages):
+    """
+    Run apt-get ``command`` for all ``packages`` in one transaction. If the
+    transaction fails each package is tried in a transaction of its own.
     
+    Returns a dictionary of packages and whether the command succeeded for each
+    """
+    if not packages: return {}
+    #install silent and answer yes by default -qqy
+    with settings(warn_only=True):
+        result = sudo('apt-get%s %s -qqy %s'% (_apt_options(),command,' '.join([_apt_argument(p) for p in packages])), pty=True)
+    forget_packages()
+    forget_facts()
+    if not result.failed:
+        return dict([(package, True) for package in packages])
+    if env.verbosity:
+        print env.host, "WARNING: apt-get %s failed. Trying each package separately"% command
+    outcomes = {}
+    for package in packages:
+        with settings(warn_only=True):
+            outcomes[package] = not sudo('apt-get%s %s -qqy %s'% (_apt_options(),command,_apt_argument(package)), pty=True).failed
+    forget_packages()
+    forget_facts()
+    return outcomes
+
 def install_packages():
     """
     Install a set of baseline packages and configure where necessary
@@ -186,11 +289,8 @@ def install_packages():
 
     if env.verbosity:
         print env.host, "INSTALLING & CONFIGURING NODE PACKAGES:"
-    #Get a list of installed packages
-    p = run("dpkg -l | awk '/ii/ {print $2}'").split('\n')
-    
     #Remove apparmor - TODO we may enable this later
-    if env.overwrite or not server_state('apparmor-disabled') and 'apparmor' in p:
+    if env.overwrite or not server_state('apparmor-disabled') and package_installed('apparmor'):
         with settings(warn_only=True):
             sudo('/etc/init.d/apparmor stop')
             sudo('update-rc.d -f apparmor remove')
@@ -201,12 +301,27 @@ def install_packages():
     env.installed_packages[env.host] = []
     role = env.role_lookup[env.host_string]
     packages = get_packages()
-    for package in packages:
-        if not package in p:
-            install_package(package)
+    #install the missing and outdated packages in one apt transaction
+    missing, outdated = package_diff(get_packages(pinned=True))
+    outcomes = _apt_transaction('install', missing + outdated)
+    #confirm each package against the new inventory
+    unsatisfied = sum(package_diff(missing + outdated),[])
+    failed = []
+    for package in missing + outdated:
+        name = parse_package(package)[0]
+        if outcomes[package] and package not in unsatisfied:
             if env.verbosity:
-                print ' * installed',package
-            env.installed_packages[env.host].append(package)
+                print ' * installed',name,package_version(name)
+            env.installed_packages[env.host].append(name)
+        elif outcomes[package]:
+            print ' * FAILED to install',package,'- found version',package_version(name)
+            failed.append(package)
+        else:
+            print ' * FAILED to install',package
+            failed.append(package)
+    if failed:
+        print env.host, "ERROR: Could not install", ', '.join(failed)
+        sys.exit(1)
     if env.overwrite or env.installed_packages[env.host]: #always store the latest complete list
         set_server_state('packages_installed', packages)
         env.installed_packages[env.host] = packages
@@ -224,9 +339,18 @@ def install_packages():
     #is current whereas pip always downloads.
     #Once both these packages mature we'll move to using the standard Ubuntu packages
     if (env.overwrite or not server_state('pip-venv-wrapper-installed')) and 'python-setuptools' in packages:
-        sudo("easy_install virtualenv")
-        sudo("easy_install pip")
-        sudo("easy_install virtualenvwrapper")
+        local_cache = _seed_package_cache()
+        if local_cache:
+            python_cache = '/'.join([PACKAGE_CACHE_DIR,'python'])
+            dists = os.listdir(os.path.join(local_cache,'python'))
+            #download them into the cache unless an earlier host collected them
+            if [p for p in ['virtualenv-','pip-','virtualenvwrapper-'] if not [d for d in dists if d.startswith(p)]]:
+                run("easy_install -zmaxd %s virtualenv pip virtualenvwrapper"% python_cache)
+            sudo("easy_install -H None -f %s virtualenv pip virtualenvwrapper"% python_cache)
+        else:
+            sudo("easy_install virtualenv")
+            sudo("easy_install pip")
+            sudo("easy_install virtualenvwrapper")
         if env.verbosity:
             print " * easy installed pip, virtualenv, virtualenvwrapper"
         set_server_state('pip-venv-wrapper-installed')
@@ -236,6 +360,8 @@ def install_packages():
 
     #cleanup after easy_install
     sudo("rm -rf build")
+    _collect_package_cache()
+
 
 def lsb_release():
     """
@@ -251,20 +377,12 @@ def lsb_release():
     release = 10.04
     codename = lucid
     
+    The information comes from the host's facts
     """
-    
-    output = run('lsb_release -a').split('\n')
+    facts = host_facts()
     release = _AttributeDict({})
-    for line in output:
-        try:
-            key, value = line.split(':')
-        except ValueError:
-            continue
-        release[key.strip().replace(' ','_').lower()]=value.strip()
-   
-    if exists('/etc/debian_version'): release.base = 'debian'
-    elif exists('/etc/redhat-release'): release.base = 'redhat'
-    else: release.base = 'unknown'
+    for key in ['base','distributor_id','description','release','codename']:
+        release[key] = facts.get(key,'')
     return release
     
 def port_is_open():
@@ -275,6 +393,8 @@ def port_is_open():
         try:
             if env.verbosity:
                 print "Testing node for previous installation on port %s:"% env.port
+            #gather fresh facts as the test
+            host_facts(refresh=True)
             distribution = lsb_release()
         except KeyboardInterrupt:
             if env.verbosity:
@@ -358,12 +478,11 @@ def setup_ufw():
     Setup basic ufw rules just for ssh login
     """
     if not env.ENABLE_UFW: return
-   
+
     ufw_state = server_state('ufw_installed')
     if ufw_state and not env.overwrite or ufw_state == str(env.HOST_SSH_PORT): return
     #check for actual package
-    ufw = run("dpkg -l | grep 'ufw' | awk '{print $2}'").strip()
-    if not ufw:
+    if not package_installed('ufw'):
         if env.verbosity:
             print env.host, "INSTALLING & ENABLING FIREWALL ufw"
         install_package('ufw')
@@ -410,24 +529,23 @@ def setup_ufw_rules():
     if env.verbosity:
         print 'CONFIGURING FIREWALL'
     
+    rules = Batch(fail_fast=False)
     delete_rules = current_rules - firewall_rules
     for rule in delete_rules:
-        with settings(warn_only=True):
-            if env.verbosity:
-                print 'ufw delete', rule
-            sudo('ufw delete %s'% rule)
+        if env.verbosity:
+            print 'ufw delete', rule
+        rules.sudo('ufw delete %s'% rule)
     new_rules = firewall_rules - current_rules        
     for rule in new_rules:
-        with settings(warn_only=True):
-            if env.verbosity:
-                print 'ufw', rule
-            sudo('ufw %s'% rule)
+        if env.verbosity:
+            print 'ufw', rule
+        rules.sudo('ufw %s'% rule)
+    reload = rules.sudo('ufw reload')
+    rules.execute()
     set_server_state('ufw_rules',list(firewall_rules))
 
-        
-    output = sudo('ufw reload')
     if env.verbosity:
-        print output
+        print reload.output
 
     
 
@@ -439,6 +557,8 @@ def uninstall_package(package):
     apt-get autoremove --purge
     """
     sudo('apt-get autoremove --purge -qqy %s'% package, pty=True)
+    forget_packages()
+    forget_facts()
 
 def uninstall_packages():
     """
@@ -450,31 +570,86 @@ def uninstall_packages():
     env.uninstalled_packages[env.host] = []
     #first uninstall any that have been taken off the list
     packages = set(get_packages())
-    uninstall = installed - packages
+    #only those still installed
+    uninstall = sorted([p for p in installed - packages if package_installed(p)])
     if uninstall and env.verbosity:
         print env.host,'UNINSTALLING HOST PACKAGES'
+    #remove them and their unused dependencies in one apt transaction
+    outcomes = _apt_transaction('autoremove --purge', uninstall)
     for p in uninstall:
-        if env.verbosity:
-            print ' - uninstalling',p
-        uninstall_package(p)
-        env.uninstalled_packages[env.host].append(p)
+        if outcomes[p] and not package_installed(p):
+            if env.verbosity:
+                print ' - uninstalled',p
+            env.uninstalled_packages[env.host].append(p)
+        else:
+            print ' - FAILED to uninstall',p
+    failed = [p for p in uninstall if p not in env.uninstalled_packages[env.host]]
+    if failed:
+        print env.host, "ERROR: Could not uninstall", ', '.join(failed)
+        sys.exit(1)
     set_server_state('packages_installed',get_packages())
     return
 
 def upgrade_packages():
     """
     apt-get update and apt-get upgrade
+    
+    apt-get update is skipped while the package lists are younger than env.APT_UPDATE_TTL
+    seconds and the sources have not changed. apt-get upgrade is skipped if the lists
+    have not been updated since the last upgrade or a simulated upgrade has nothing to do.
+    The decisions are kept in the apt-packages server state.
     """
     if env.verbosity:
         print env.host, "apt-get UPDATING and UPGRADING SERVER PACKAGES"
-        print " * running apt-get update "
-    sudo('apt-get -qqy update')
-    if env.verbosity:
-        print " * running apt-get upgrade"
-        print " NOTE: apt-get upgrade has been known in rare cases to require user input."
-        print "If apt-get upgrade does not complete within 15 minutes"
-        print "see troubleshooting docs *before* aborting the process to avoid package management corruption."
-    sudo('apt-get -qqy upgrade')
+    state = server_state('apt-packages')
+    if not isinstance(state,dict): state = {}
+    #the host's clock, the age of the package lists and the sources in one round trip
+    with settings(hide('running','stdout'),warn_only=True):
+        output = run("date +%s; stat -c %Y /var/lib/apt/lists; "
+                     "cat /etc/apt/sources.list /etc/apt/sources.list.d/*.list 2>/dev/null | sha1sum").split('\n')
+    try:
+        now, updated = int(output[0]), int(output[1])
+        sources = output[2].split()[0]
+    except (ValueError, IndexError):
+        now, updated, sources = 0, 0, ''
+    fingerprint = sha1(sources + json.dumps(server_state('linux_package_repositories'))).hexdigest()
+    #apt only rewrites the lists that changed so our own last update counts as well
+    updated = max(updated, state.get('updated',0))
+    ttl = env.get('APT_UPDATE_TTL')
+    if not env.overwrite and ttl and sources and 0 <= now - updated < ttl and state.get('fingerprint') == fingerprint:
+        if env.verbosity:
+            print " * skipped apt-get update, the package lists are %s minutes old"% ((now - updated)/60)
+    else:
+        if env.verbosity:
+            print " * running apt-get update "
+        sudo('apt-get -qqy update')
+        updated = state['updated'] = now
+        state['fingerprint'] = fingerprint
+
+    pending = None
+    if not env.overwrite and state.get('upgraded',-1) >= updated:
+        pending = 0
+    elif not env.overwrite:
+        with settings(hide('running','stdout'),warn_only=True):
+            simulated = run("apt-get -s upgrade | grep -c '^Inst '")
+        try:
+            pending = int(simulated.strip())
+        except ValueError:
+            pass
+    if pending == 0:
+        if env.verbosity:
+            print " * skipped apt-get upgrade, there is nothing to upgrade"
+    else:
+        if env.verbosity:
+            print " * running apt-get upgrade"
+            print " NOTE: apt-get upgrade has been known in rare cases to require user input."
+            print "If apt-get upgrade does not complete within 15 minutes"
+            print "see troubleshooting docs *before* aborting the process to avoid package management corruption."
+        sudo('apt-get%s -qqy upgrade'% _apt_options())
+        forget_packages()
+    state['upgraded'] = now
+    set_server_state('apt-packages',state)
+
 
 def upload_etc():
     """
@@ -487,51 +662,43 @@ def upload_etc():
     it is intended that this function only replace existing configuration files. To ensure we don't upload 
     etc files that are intended to accompany a particular package.
     """
-    role = env.role_lookup[env.host_string]
-    packages = env.packages[role]
-    #determine the templatedir
+    packages = get_packages()
     if env.verbosity:
         print "UPLOAD ETC configuration templates"
-    if not hasattr(env, 'project_template_dir'):
-        #the normal pattern would mean the shortest path is the main one.
-        #its probably the last listed
-        length = 1000
-        env.project_template_dir = ''
-        for dir in env.TEMPLATE_DIRS:
-            if dir:
-                len_dir = len(dir)
-                if len_dir < length:
-                    length = len_dir
-                    env.project_template_dir = dir
-
-    template_dir = os.path.join(os.path.split(os.path.realpath(__file__))[0],'templates','')
-    default_templates = _get_template_files(template_dir)
-    if env.project_template_dir: user_templates = _get_template_files(os.path.join(env.project_template_dir,''))
-    else: user_templates = set([])
-    etc_templates = user_templates | default_templates
-
-    context = {'host_ip':socket.gethostbyname(env.host)}
+
+    inventory = _etc_templates()
+
+    #files in these directories must be replacing an existing file
+    replace_dirs = ['/etc','/etc/init.d','/etc/init','/etc/logrotate.d','/etc/rsyslog.d']
+    candidates = []
+    for directory, templates in inventory.items():
+        if directory in replace_dirs: candidates += [dest for t, dest in templates]
+        elif directory <> '/etc/ufw/applications.d': candidates.append(directory)
+    #check which candidate files and directories exist in one round trip
+    existing = prefetch(sorted(candidates),use_sudo=True)
+
+    context = {'host_ip':host_facts().ip,'facts':template_facts()}
     if env.overwrite or env.installed_packages[env.host]: mod_only = False
     else: mod_only = True
-    for t in etc_templates:
-        dest = t.replace('woven','',1)
-        directory,filename = os.path.split(dest)
-        package_name = filename.split('.')[0]
-        if directory in ['/etc','/etc/init.d','/etc/init','/etc/logrotate.d','/etc/rsyslog.d']:
-            #must be replacing an existing file
-            if not exists(dest) and package_name not in packages: continue
-        elif directory == '/etc/ufw/applications.d':
-            #must be a package name
-            if filename not in packages: continue
-        elif not exists(directory, use_sudo=True): continue
-        uploaded = upload_template(t,dest,context=context,use_sudo=True, modified_only=mod_only)
-            
-        if uploaded:
-            sudo(' '.join(["chown root:root",dest]))
-            if 'init.d' in dest: sudo(' '.join(["chmod ugo+rx",dest]))
-            else: sudo(' '.join(["chmod ugo+r",dest]))
-            if env.verbosity:
-                print " * uploaded",dest
+    templates = []
+    for directory in sorted(inventory):
+        for t, dest in inventory[directory]:
+            filename = os.path.basename(dest)
+            package_name = filename.split('.')[0]
+            if directory in replace_dirs:
+                if dest not in existing and package_name not in packages: continue
+            elif directory == '/etc/ufw/applications.d':
+                #must be a package name
+                if filename not in packages: continue
+            elif directory not in existing: continue
+            if 'init.d' in dest: mode = 'ugo+rx'
+            else: mode = 'ugo+r'
+            templates.append((t,dest,context,mode))
+
+    uploaded = upload_templates(templates,use_sudo=True,modified_only=mod_only,owner='root:root')
+    if env.verbosity:
+        for dest in uploaded:
+            print " * uploaded",dest
 
 def upload_ssh_key(rollback=False):
     """
@@ -580,4 +747,5 @@ def upload_ssh_key(rollback=False):
             _restore_file('/home/%s/.ssh/authorized_keys'% env.user)
         else: #no pre-existing keys remove the .ssh directory
             sudo('rm -rf /home/%s/.ssh')
+            forget('/home/%s/.ssh'% env.user)
         return    
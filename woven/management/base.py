@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import sys
+import multiprocessing, sys, threading, time, traceback
 
 from optparse import make_option
 
@@ -8,11 +8,64 @@ from django.core.management.base import BaseCommand
 from django.core.management.color import no_style
 
 from fabric import state 
+from fabric.state import connections
 from fabric.main import _merge
-from fabric.network import normalize
 from fabric.context_managers import hide,show
 
-from woven.environment import set_env
+from woven.environment import set_env, begin_state_journal, flush_state_journal
+from woven.environment import DeployContext, current_context
+from woven.deployment import close_ssh_master, render_cache_stats
+from woven.files import clear_file_cache, file_cache_stats
+from woven.packages import forget_packages
+
+class HostOutput(object):
+    """
+    Writes whole lines to ``stream`` prefixed with the ``host``
+    so output from concurrent hosts can be told apart.
+
+    Without a ``host`` each thread's lines are prefixed with the host
+    of its current DeployContext
+    """
+    def __init__(self, stream, host=None):
+        self.stream = stream
+        self.host = host
+        self.lines = {}
+
+    def write(self, text):
+        host = self.host
+        if not host and current_context(): host = current_context().host_string
+        thread = threading.current_thread()
+        lines = (self.lines.get(thread,('',''))[1] + text).split('\n')
+        self.lines[thread] = (host, lines.pop())
+        for line in lines: self._write_line(host, line)
+
+    def _write_line(self, host, line):
+        prefix = host and '[%s]'% host
+        #fabric already prefixes remote output
+        if prefix and not line.startswith(prefix): line = ' '.join([prefix,line])
+        self.stream.write(line+'\n')
+        
+    def flush(self):
+        self.stream.flush()
+        
+    def close(self):
+        for host, line in self.lines.values():
+            if line: self._write_line(host, line)
+        self.lines = {}
+        self.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+#Options for commands that can roll out to hosts in waves
+rolling_option_list = (
+    make_option('--batch-size', type='int', default=None,
+        help="run on waves of this many hosts at a time, and stop if any host in a wave fails"
+    ),
+    make_option('--max-unavailable', type='int', default=None,
+        help="the most hosts that can have their webservers stopped at the same time. Defaults to the batch size"
+    ),
+)
 
 class WovenCommand(BaseCommand):
     option_list = BaseCommand.option_list + (
@@ -38,6 +91,13 @@ class WovenCommand(BaseCommand):
             default=None,
             help="password for use with authentication and/or sudo"
         ),
+        
+        make_option('--parallel', type='int', default=None,
+            help="the number of hosts to run on at the same time. Implies --noinput. Defaults to the PARALLEL setting"
+        ),
+        make_option('--parallel-mode', choices=['process','thread'], default=None,
+            help="run parallel hosts in worker 'process'es or 'thread's. Defaults to the PARALLEL_MODE setting"
+        ),
     
         make_option('--setup',
             help='The /path/to/dir containing the setup.py module. The command will execute from this directory. Only required if you are not executing the command from below the setup.py directory',
@@ -53,6 +113,178 @@ class WovenCommand(BaseCommand):
         """
         This will be executed per host - override in subclass
         """
+    def _handle_host(self, *args, **options):
+        """
+        Runs handle_host with state writes journaled and flushed at the end,
+        even if the host fails part way through, then closes the host's shared ssh connection
+        """
+        begin_state_journal()
+        try:
+            self.handle_host(*args, **options)
+        finally:
+            flush_state_journal(end=True)
+            close_ssh_master()
+            cached, rendered = render_cache_stats()
+            if state.env.verbosity and cached:
+                print state.env.host,"Rendered %s templates, %s more from the render cache (%d%% hit rate)"% \
+                      (rendered, cached, 100*cached/(cached+rendered))
+            saved, made = file_cache_stats()
+            if state.env.verbosity and saved:
+                print state.env.host,"The remote file cache saved %s of %s file checks"% (saved, saved+made)
+            clear_file_cache()
+            forget_packages()
+            
+    def _run_host(self, host, *args, **options):
+        """
+        Runs the command on ``host``
+        """
+        #hide output outside the host context so fabric's own output threads see it
+        if int(state.env.verbosity) < 2:
+            with hide('warnings', 'running', 'stdout', 'stderr'):
+                self._run_host_context(host, *args, **options)
+        else:
+            self._run_host_context(host, *args, **options)
+
+    def _run_host_context(self, host, *args, **options):
+        """
+        Runs the command in a DeployContext for ``host``, so the host string, user and port
+        and anything cached about the host are discarded when it completes
+        """
+        with DeployContext(host):
+            self._handle_host(*args, **options)
+
+    def _run_host_process(self, host, *args, **options):
+        """
+        Runs the command on ``host`` in a worker process with prefixed output.
+        Worker processes can't prompt so the command runs non-interactively.
+        """
+        sys.stdout = HostOutput(sys.stdout, host)
+        sys.stderr = HostOutput(sys.stderr, host)
+        #never share a parent connection with the worker
+        connections.clear()
+        try:
+            self._run_host(host, *args, **options)
+        finally:
+            sys.stdout.close()
+            sys.stderr.close()
+
+    def _run_host_thread(self, host, exitcodes, *args, **options):
+        """
+        Runs the command on ``host`` in a worker thread and records its exit code
+        """
+        with DeployContext(host):
+            try:
+                self._handle_host(*args, **options)
+                exitcodes[host] = 0
+            except SystemExit, e:
+                if e.code is None or isinstance(e.code, int): exitcodes[host] = e.code or 0
+                else:
+                    print e.code
+                    exitcodes[host] = 1
+            except:
+                traceback.print_exc()
+                exitcodes[host] = 1
+
+    def _run_workers(self, hosts, parallel, threads, exitcodes, *args, **options):
+        """
+        Starts a worker process or thread per host, with at most ``parallel`` running
+        """
+        pending = list(hosts)
+        running = []
+        while pending or running:
+            while pending and len(running) < parallel:
+                host = pending.pop(0)
+                #don't let a worker process inherit and repeat any buffered output
+                sys.stdout.flush()
+                sys.stderr.flush()
+                if threads:
+                    worker = threading.Thread(target=self._run_host_thread, args=(host, exitcodes)+args,
+                                              kwargs=options, name=host)
+                    worker.daemon = True
+                else:
+                    worker = multiprocessing.Process(target=self._run_host_process, args=(host,)+args,
+                                                     kwargs=options, name=host)
+                worker.start()
+                running.append((host, worker))
+            time.sleep(0.1)
+            for host, worker in running[:]:
+                if not worker.is_alive():
+                    worker.join()
+                    if not threads: exitcodes[host] = worker.exitcode
+                    running.remove((host, worker))
+
+    def _run_batch(self, hosts, parallel, exitcodes, *args, **options):
+        """
+        Runs the command on up to ``parallel`` ``hosts`` at once, each in its own process
+        or thread, recording each host's exit code in ``exitcodes``
+        """
+        threads = self._parallel_threads(**options)
+        #workers can't prompt
+        state.env.INTERACTIVE = False
+        stdout, stderr = sys.stdout, sys.stderr
+        if threads:
+            sys.stdout = HostOutput(stdout)
+            sys.stderr = HostOutput(stderr)
+        try:
+            #threads share fabric's output settings so hide them once for every host
+            if threads and int(state.env.verbosity) < 2:
+                with hide('warnings', 'running', 'stdout', 'stderr'):
+                    self._run_workers(hosts, parallel, threads, exitcodes, *args, **options)
+            else:
+                self._run_workers(hosts, parallel, threads, exitcodes, *args, **options)
+        finally:
+            if threads:
+                sys.stdout.close()
+                sys.stderr.close()
+                sys.stdout, sys.stderr = stdout, stderr
+
+    def _parallel_threads(self, **options):
+        return (options.get('parallel_mode') or state.env.get('PARALLEL_MODE','process')) == 'thread'
+
+    def _summarise(self, hosts, exitcodes):
+        """
+        Prints the outcome for each host and exits with an error if any host failed or was skipped
+        """
+        failed = [host for host in hosts if exitcodes.get(host,1)]
+        if state.env.verbosity or failed:
+            print "SUMMARY:"
+            for host in hosts:
+                if host not in exitcodes: print ' * %s skipped'% host
+                elif exitcodes[host]: print ' * %s FAILED (exit code %s)'% (host,exitcodes[host])
+                else: print ' * %s ok'% host
+        if failed:
+            sys.exit(1)
+
+    def _run_hosts_parallel(self, hosts, parallel, *args, **options):
+        """
+        Runs the command on up to ``parallel`` ``hosts`` at once,
+        then prints a summary and exits with an error if any host failed
+        """
+        exitcodes = {}
+        self._run_batch(hosts, parallel, exitcodes, *args, **options)
+        self._summarise(hosts, exitcodes)
+
+    def _run_hosts_rolling(self, hosts, batch_size, max_unavailable, *args, **options):
+        """
+        Runs the command on waves of ``batch_size`` hosts at a time. At most ``max_unavailable``
+        hosts have their webservers stopped by ``activate`` at any one time.
+        The rollout stops after the first wave in which any host fails.
+        """
+        if self._parallel_threads(**options): slots = threading.Semaphore(max_unavailable)
+        else: slots = multiprocessing.Semaphore(max_unavailable)
+        state.env.unavailable_slots = slots
+        exitcodes = {}
+        waves = [hosts[i:i+batch_size] for i in range(0, len(hosts), batch_size)]
+        for n, wave in enumerate(waves):
+            if state.env.verbosity:
+                print "WAVE %s of %s:"% (n+1, len(waves)), ', '.join(wave)
+            self._run_batch(wave, batch_size, exitcodes, *args, **options)
+            if [host for host in wave if exitcodes.get(host,1)]:
+                if n+1 < len(waves): print "ERROR: Stopping the rollout. A host in wave %s failed"% (n+1)
+                break
+        state.env.unavailable_slots = None
+        self._summarise(hosts, exitcodes)
+
     def parse_host_args(self, *args):
         """
         Returns a comma separated string of hosts
@@ -117,23 +349,16 @@ class WovenCommand(BaseCommand):
         #state.env.command = self.name
         # Set host list (also copy to env)
         state.env.all_hosts = hosts = state.env.hosts
+        batch_size = options.get('batch_size')
+        max_unavailable = options.get('max_unavailable')
+        if batch_size or max_unavailable:
+            self._run_hosts_rolling(hosts, batch_size or max_unavailable,
+                                    max_unavailable or batch_size, *args, **options)
+            return
+        parallel = options.get('parallel') or state.env.get('PARALLEL',1)
+        if parallel > 1 and len(hosts) > 1:
+            self._run_hosts_parallel(hosts, parallel, *args, **options)
+            return
         # If hosts found, execute the function on each host in turn
         for host in hosts:
-            # Preserve user
-            prev_user = state.env.user
-            # Split host string and apply to env dict
-            #TODO - This section is replaced by network.interpret_host_string in Fabric 1.0
-            username, hostname, port = normalize(host)
-            state.env.host_string = host
-            state.env.host = hostname
-            state.env.user = username
-            state.env.port = port
-
-            # Actually run command
-            if int(state.env.verbosity) < 2:
-                with hide('warnings', 'running', 'stdout', 'stderr'):
-                    self.handle_host(*args, **options)
-            else:
-                self.handle_host(*args, **options)
-            # Put old user back
-            state.env.user = prev_user
+            self._run_host(host, *args, **options)
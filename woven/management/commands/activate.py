@@ -5,7 +5,7 @@ from fabric.state import env
 
 from woven.environment import project_version
 from woven.virtualenv import activate
-from woven.management.base import WovenCommand
+from woven.management.base import WovenCommand, rolling_option_list
 
 class Command(WovenCommand):
     """
@@ -13,6 +13,7 @@ class Command(WovenCommand):
     
     e.g. python manage.py activate 0.1
     """
+    option_list = WovenCommand.option_list + rolling_option_list
 
     help = "Activate a version of your project"
     requires_model_validation = False
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+from fabric.state import env
+
+from woven.environment import compact_state
+from woven.management.base import WovenCommand
+
+class Command(WovenCommand):
+    """
+    Remove the server state of project versions that no longer have a virtualenv
+    and re-index the state directory
+    
+    Basic Usage:
+    ``python manage.py compactstate [user]@[hoststring]``
+    
+    """
+    help = "Remove server state left behind by removed versions of your project"
+    requires_model_validation = False
+    
+    def handle_host(self,*args, **options):
+        removed = compact_state()
+        if env.verbosity:
+            print env.host, "COMPACTED STATE"
+            for name in removed:
+                print ' - removed', name
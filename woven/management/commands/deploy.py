@@ -5,7 +5,7 @@ from fabric.context_managers import settings
 
 from woven.api import deploy
 from woven.virtualenv import activate
-from woven.management.base import WovenCommand
+from woven.management.base import WovenCommand, rolling_option_list
 
 
 class Command(WovenCommand):
@@ -22,6 +22,9 @@ class Command(WovenCommand):
     For just the current user
     ``python manage.py deploy host.example.com``
     
+    Rolling out to a role in waves of 5 hosts
+    ``python manage.py deploy production --batch-size=5``
+    
     """
     option_list = WovenCommand.option_list + (
         make_option('-m', '--migration',
@@ -49,7 +52,7 @@ class Command(WovenCommand):
             help="Overwrite an existing installation"
         ),
         
-    )
+    ) + rolling_option_list
     help = "Deploy the current version of your project"
     requires_model_validation = False
     
@@ -0,0 +1,140 @@
+"""
+An inventory of the packages on the current host.
+
+The name, version, architecture and status of every package dpkg knows about is
+read in one dpkg-query call and kept for the rest of the run, so checking
+whether a package is installed costs no round trip. Woven forgets the inventory
+whenever it installs or removes packages.
+
+Packages in the settings may be pinned to versions, for example 'nginx>=1.0',
+with the Debian operators <<, <=, =, >=, >> or the familiar <, ==, >.
+"""
+import re, threading
+
+from fabric.state import _AttributeDict, env
+from fabric.operations import run
+from fabric.context_managers import settings, hide
+
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+_spec = re.compile(r'^([^<>=\s]+)\s*(>=|<=|==|>>|<<|=|>|<)?\s*(\S*)$')
+
+def parse_package(spec):
+    """
+    Returns the (name, operator, version) of a package ``spec`` such as 'nginx>=1.0'.
+    An unpinned package has an empty operator and version.
+    """
+    match = _spec.match(spec.strip())
+    if not match or bool(match.group(2)) <> bool(match.group(3)):
+        raise ValueError("Invalid package %s"% spec)
+    return match.group(1), match.group(2) or '', match.group(3)
+
+def package_name(spec):
+    return parse_package(spec)[0]
+
+def _order(c):
+    #debian sorts ~ before everything, even the end of the string, and letters before other characters
+    if c == '~': return -1
+    if c.isalpha(): return ord(c)
+    return ord(c) + 256
+
+def _compare_part(a, b):
+    a = re.findall(r'(\D*)(\d*)', a)
+    b = re.findall(r'(\D*)(\d*)', b)
+    for i in range(max(len(a),len(b))):
+        a_text, a_digits = i < len(a) and a[i] or ('','')
+        b_text, b_digits = i < len(b) and b[i] or ('','')
+        a_order = [_order(c) for c in a_text]
+        b_order = [_order(c) for c in b_text]
+        length = max(len(a_order),len(b_order))
+        result = cmp(a_order + [0]*(length-len(a_order)), b_order + [0]*(length-len(b_order)))
+        if not result: result = cmp(int(a_digits or 0),int(b_digits or 0))
+        if result: return result
+    return 0
+
+def compare_versions(a, b):
+    """
+    Compares two Debian package versions as dpkg does
+    """
+    def split(version):
+        epoch, sep, version = version.partition(':') if ':' in version else ('0','',version)
+        upstream, sep, revision = version.rpartition('-')
+        if not sep: upstream, revision = revision, ''
+        return int(epoch or 0), upstream, revision
+    a_epoch, a_upstream, a_revision = split(a)
+    b_epoch, b_upstream, b_revision = split(b)
+    return cmp(a_epoch,b_epoch) or _compare_part(a_upstream,b_upstream) or _compare_part(a_revision,b_revision)
+
+def satisfies(version, operator, wanted):
+    """
+    True if ``version`` satisfies the pin ``operator`` ``wanted``
+    """
+    if not operator: return True
+    result = compare_versions(version, wanted)
+    return {'>=':result >= 0, '<=':result <= 0,
+            '=':result == 0, '==':result == 0,
+            '>>':result > 0, '>':result > 0,
+            '<<':result < 0, '<':result < 0}[operator]
+
+def package_inventory():
+    """
+    Returns a dictionary of the packages dpkg knows about on the current host.
+    Each package has a name, version, architecture and status.
+    """
+    with _inventories_lock:
+        inventory = _inventories.get(env.host_string)
+    if inventory is not None: return inventory
+    with settings(hide('running','stdout')):
+        output = run("dpkg-query -W -f='${Package} ${Version} ${Architecture} ${Status}\\n'")
+    inventory = {}
+    for line in output.split('\n'):
+        fields = line.split(None,3)
+        if len(fields) < 4: continue
+        name, version, architecture, status = fields
+        inventory[name] = _AttributeDict({'name':name,'version':version,
+                                          'architecture':architecture,'status':status.strip()})
+    with _inventories_lock:
+        _inventories[env.host_string] = inventory
+    return inventory
+
+def package_version(name):
+    """
+    The installed version of the package ``name`` or None if it is not installed
+    """
+    package = package_inventory().get(name)
+    #removed packages keep their configuration files and stay in the inventory
+    if package and package.status.endswith(' installed'): return package.version
+    return None
+
+def package_installed(name):
+    return package_version(name) is not None
+
+def installed_packages():
+    """
+    The names of all the packages installed on the current host
+    """
+    return [name for name in package_inventory() if package_installed(name)]
+
+def package_diff(packages):
+    """
+    Compares ``packages`` with the inventory.
+
+    Returns a tuple of the packages that are not installed and those that are
+    installed at a version that does not satisfy their pin
+    """
+    missing = []
+    outdated = []
+    for spec in packages:
+        name, operator, wanted = parse_package(spec)
+        version = package_version(name)
+        if version is None: missing.append(spec)
+        elif not satisfies(version, operator, wanted): outdated.append(spec)
+    return missing, outdated
+
+def forget_packages(host_string=None):
+    """
+    Discard the inventory for ``host_string`` which defaults to the current host
+    """
+    with _inventories_lock:
+        _inventories.pop(host_string or env.host_string,None)
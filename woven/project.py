@@ -4,19 +4,19 @@ Anything related to deploying your project modules, media, and data
 """
 import os, shutil, sys
 
-from django.template.loader import render_to_string
 
 from fabric.state import env
 from fabric.operations import local, run, put, sudo
 from fabric.decorators import runs_once
-from fabric.contrib.files import exists
 from fabric.contrib.console import confirm
 #Required for a bug in 0.9
 from fabric.version import get_version
 
 from woven.decorators import run_once_per_version
-from woven.deployment import deploy_files
+from woven.deployment import deploy_files, fingerprint_tree, render_template
 from woven.environment import deployment_root, _root_domain
+from woven.files import exists, forget
+from woven.transfer import put_file
 
 @runs_once
 def _make_local_sitesettings(overwrite=False):
@@ -32,7 +32,7 @@ def _make_local_sitesettings(overwrite=False):
     if not os.path.exists(settings_file_path):
         root_domain = _root_domain()    
         u_domain = root_domain.replace('.','_')
-        output = render_to_string('woven/sitesettings.txt',
+        output = render_template('woven/sitesettings.txt',
                 {"deployment_root":deployment_root(),
                 "site_id":"1",
                 "project_name": env.project_name,
@@ -57,7 +57,13 @@ def _make_local_sitesettings(overwrite=False):
 
     return
 
-@run_once_per_version
+#Exclude a few things that we don't want deployed as part of the project folder
+PROJECT_EXCLUDE = ['local_settings*','*.pyc','*.log','.*','/build','/dist','/media*','/static*','/www','/public','/template*']
+
+def _project_fingerprint():
+    return fingerprint_tree(os.getcwd(), PROJECT_EXCLUDE)
+
+@run_once_per_version(fingerprint=_project_fingerprint)
 def deploy_project():
     """
     Deploy to the project directory in the virtualenv
@@ -68,8 +74,7 @@ def deploy_project():
     
     if env.verbosity:
         print env.host,"DEPLOYING project", env.project_fullname
-    #Exclude a few things that we don't want deployed as part of the project folder
-    rsync_exclude = ['local_settings*','*.pyc','*.log','.*','/build','/dist','/media*','/static*','/www','/public','/template*']
+    rsync_exclude = PROJECT_EXCLUDE
 
     #make site local settings if they don't already exist
     _make_local_sitesettings()
@@ -102,13 +107,10 @@ def deploy_sitesettings():
             tail = path.split('/')[-1]
             print ' * uploaded',tail
 
-@run_once_per_version
-def deploy_templates():
+def _project_template_dir():
     """
-    Deploy any templates from your shortest TEMPLATE_DIRS setting
+    The shortest TEMPLATE_DIRS path
     """
-    
-    deployed = None
     if not hasattr(env, 'project_template_dir'):
         #the normal pattern would mean the shortest path is the main one.
         #its probably the last listed
@@ -119,7 +121,19 @@ def deploy_templates():
                 if len_dir < length:
                     length = len_dir
                     env.project_template_dir = dir
+    return env.get('project_template_dir','')
+
+def _templates_fingerprint():
+    return fingerprint_tree(_project_template_dir())
+
+@run_once_per_version(fingerprint=_templates_fingerprint)
+def deploy_templates():
+    """
+    Deploy any templates from your shortest TEMPLATE_DIRS setting
+    """
     
+    deployed = None
+    _project_template_dir()
     if hasattr(env,'project_template_dir'):
         remote_dir = '/'.join([deployment_root(),'env',env.project_fullname,'templates'])
         if env.verbosity:
@@ -127,12 +141,11 @@ def deploy_templates():
         deployed = deploy_files(env.project_template_dir,remote_dir)
     return deployed
      
-@run_once_per_version
-def deploy_static():
+def _static_dirs():
     """
-    Deploy static (application) versioned media
+    Returns the local and remote directories for static media
+    or None if static media is not deployed
     """
-    
     if not env.STATIC_URL or 'http://' in env.STATIC_URL: return
     from django.core.servers.basehttp import AdminMediaHandler
     remote_dir = '/'.join([deployment_root(),'env',env.project_fullname,'static'])
@@ -156,11 +169,29 @@ def deploy_static():
             if static_url:
                 remote_dir = '/'.join([remote_dir,static_url])
         else: return
+    return local_dir, remote_dir
+
+def _static_fingerprint():
+    static_dirs = _static_dirs()
+    if not static_dirs: return ''
+    return fingerprint_tree(static_dirs[0], extra=static_dirs[1])
+
+@run_once_per_version(fingerprint=_static_fingerprint)
+def deploy_static():
+    """
+    Deploy static (application) versioned media
+    """
+    static_dirs = _static_dirs()
+    if not static_dirs: return
+    local_dir, remote_dir = static_dirs
     if env.verbosity:
         print env.host,"DEPLOYING static",remote_dir
     return deploy_files(local_dir,remote_dir)
 
-@run_once_per_version       
+def _media_fingerprint():
+    return fingerprint_tree(env.MEDIA_ROOT, extra=env.MEDIA_URL)
+
+@run_once_per_version(fingerprint=_media_fingerprint)
 def deploy_media():
     """
     Deploy MEDIA_ROOT unversioned on host
@@ -214,7 +245,8 @@ def deploy_db(rollback=False):
 
             db_name = os.path.split(db_path)[1]  
             run('mkdir -p '+db_dir)
-            put(db_path,dest_db_path)
+            put_file(db_path,dest_db_path)
+            forget(dest_db_path)
             #directory and file must be writable by webserver
             sudo("chown -R %s:www-data %s"% (env.user,db_dir))
             sudo("chmod -R ug+w %s"% db_dir)
@@ -0,0 +1,126 @@
+"""
+Runs a graph of deployment tasks on the current host.
+
+Each task is a function with a list of the tasks it requires. Tasks run in the
+order given, but with more than one worker a task starts as soon as its
+requirements have completed, on its own thread and ssh channel.
+"""
+import sys, threading, time
+
+from fabric.state import env, connections
+
+from woven.environment import DeployContext, current_context
+
+def _task_name(func):
+    return getattr(func,'__name__',str(func))
+
+def critical_path(tasks, timings):
+    """
+    Returns the chain of tasks with the longest total duration through the graph
+    as a list of (name, seconds)
+
+    ``tasks`` is a list of (func, requires) and ``timings`` a dict of
+    task names to (start, end) times
+    """
+    longest = {}
+    for func, requires in tasks:
+        name = _task_name(func)
+        if name not in timings: continue
+        start, end = timings[name]
+        before = []
+        for r in requires:
+            path = longest.get(_task_name(r),[])
+            if sum([d for n, d in path]) > sum([d for n, d in before]): before = path
+        longest[name] = before + [(name, end-start)]
+    path = []
+    for p in longest.values():
+        if sum([d for n, d in p]) > sum([d for n, d in path]): path = p
+    return path
+
+def run_tasks(tasks, workers=None, after=None):
+    """
+    Run a list of (func, requires) ``tasks`` on the current host.
+
+    Requirements that are not in ``tasks`` are treated as already complete.
+
+    ``workers`` is the number of tasks that may run at the same time and defaults
+    to env.DEPLOY_WORKERS. With one worker tasks run in the order given.
+
+    ``after`` is an optional function called with each task as it completes
+
+    Returns a dictionary of task names and results
+    """
+    if workers is None: workers = env.get('DEPLOY_WORKERS',1) or 1
+    names = [_task_name(func) for func, requires in tasks]
+    pending = [(func, [_task_name(r) for r in requires if _task_name(r) in names]) for func, requires in tasks]
+    results = {}
+    timings = {}
+    started = time.time()
+
+    if workers <= 1:
+        for func, requires in pending:
+            name = _task_name(func)
+            start = time.time()
+            results[name] = func()
+            timings[name] = (start, time.time())
+            if after: after(func)
+    else:
+        #make sure the connection is open before the tasks share it
+        if env.host_string: connections[env.host_string]
+        completed = threading.Condition()
+        running = {}
+        failed = []
+        context = current_context()
+        if context is None:
+            #outside a command there is no host context, so one shares the host's
+            #state snapshots and journals with every task
+            context = DeployContext(env.host_string, state_snapshots=env.setdefault('state_snapshots',{}),
+                                    state_journals=env.setdefault('state_journals',{}))
+
+        def run_task(func, name):
+            start = time.time()
+            try:
+                #settings and cd in one task must not change env for the others
+                with DeployContext(parent=context):
+                    results[name] = func()
+            except BaseException:
+                failed.append(sys.exc_info())
+            with completed:
+                timings[name] = (start, time.time())
+                del running[name]
+                completed.notify()
+
+        with completed:
+            while pending or running:
+                if not failed:
+                    for task in pending[:]:
+                        func, requires = task
+                        if len(running) >= workers: break
+                        if [r for r in requires if r not in timings]: continue
+                        name = _task_name(func)
+                        pending.remove(task)
+                        thread = threading.Thread(target=run_task, args=(func, name), name=name)
+                        thread.daemon = True
+                        running[name] = thread
+                        thread.start()
+                if not running:
+                    if pending and not failed:
+                        print env.host, "ERROR: Unresolved task requirements", ', '.join([_task_name(f) for f, r in pending])
+                        sys.exit(1)
+                    break
+                done = set(timings)
+                #wait with a timeout so the main thread can still be interrupted
+                completed.wait(1)
+                if after:
+                    for func, requires in tasks:
+                        name = _task_name(func)
+                        if name in timings and name not in done and name in results: after(func)
+        if failed:
+            raise failed[0][0], failed[0][1], failed[0][2]
+
+    if env.verbosity:
+        path = critical_path(tasks, timings)
+        print env.host, "CRITICAL PATH %.1fs of %.1fs elapsed:"% (sum([d for n, d in path]), time.time()-started)
+        for name, seconds in path:
+            print ' * %s %.1fs'% (name, seconds)
+    return results
@@ -0,0 +1,153 @@
+"""
+Chunked, resumable transfer of large files to the current host.
+
+A file larger than env.LARGE_FILE_THRESHOLD is split into chunks which are sent
+over several sftp channels of the host's connection at the same time. Each chunk
+is named by its position and checked against its sha1 on the host, so an
+interrupted transfer resumes with the chunks that are missing or corrupt. The file
+is only reassembled and moved into place once every chunk has been verified.
+"""
+import os, sys, threading
+from hashlib import sha1
+
+from fabric.state import env, connections
+from fabric.operations import put, run, sudo
+from fabric.context_managers import settings, hide
+
+#transfers are retried this many times if a chunk fails verification
+ATTEMPTS = 3
+
+#only complete chunks, not the .part files of chunks being sent
+CHUNK_GLOB = '[0-9]'*6
+
+def _chunk_hashes(local_path, chunk_size):
+    """
+    Returns a list of the sha1 of each ``chunk_size`` chunk of ``local_path``
+    """
+    hashes = []
+    f = open(local_path,'rb')
+    for chunk in iter(lambda: f.read(chunk_size), ''):
+        hashes.append(sha1(chunk).hexdigest())
+    f.close()
+    return hashes
+
+def _chunk_name(chunk_dir, index):
+    #padded so the shell sorts the chunks in order
+    return '/'.join([chunk_dir,'%06d'% index])
+
+def _send_chunks(local_path, chunk_dir, chunk_size, indexes, channels):
+    """
+    Sends the chunks of ``local_path`` at ``indexes`` into ``chunk_dir`` on the host
+    over ``channels`` sftp channels at once
+    """
+    pending = list(indexes)
+    lock = threading.Lock()
+    failed = []
+    connection = connections[env.host_string]
+
+    def send():
+        try:
+            sftp = connection.open_sftp()
+            f = open(local_path,'rb')
+            try:
+                while True:
+                    with lock:
+                        if not pending or failed: return
+                        index = pending.pop(0)
+                    f.seek(index*chunk_size)
+                    name = _chunk_name(chunk_dir,index)
+                    remote_file = sftp.open(name+'.part','wb')
+                    remote_file.set_pipelined(True)
+                    remote_file.write(f.read(chunk_size))
+                    remote_file.close()
+                    #only a complete chunk has its final name
+                    try:
+                        sftp.remove(name)
+                    except IOError:
+                        pass
+                    sftp.rename(name+'.part',name)
+            finally:
+                f.close()
+                sftp.close()
+        except Exception:
+            failed.append(sys.exc_info())
+
+    threads = [threading.Thread(target=send) for i in range(max(min(channels,len(pending)),1))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        #join with a timeout so the main thread can still be interrupted
+        while thread.isAlive(): thread.join(1)
+    if failed:
+        raise failed[0][0], failed[0][1], failed[0][2]
+
+def put_file(local_path, remote_path, use_sudo=False):
+    """
+    Uploads ``local_path`` to ``remote_path`` on the current host.
+
+    Files larger than env.LARGE_FILE_THRESHOLD are sent in env.LARGE_FILE_CHUNK_SIZE
+    chunks over env.LARGE_FILE_CHANNELS concurrent channels, and a transfer of the
+    same file that was interrupted resumes with the chunks not already on the host.
+    Smaller files are sent with ``put``.
+
+    With ``use_sudo`` the file is moved into place as root.
+    """
+    threshold = env.get('LARGE_FILE_THRESHOLD')
+    size = os.path.getsize(local_path)
+    func = use_sudo and sudo or run
+    if not threshold or size <= threshold:
+        if not use_sudo: return put(local_path,remote_path)
+        #a fresh directory of our own so nothing another user left in /tmp is moved into place
+        with settings(hide('running','stdout')):
+            temp_dir = run('mktemp -d /tmp/woven-put-XXXXXXXX').strip()
+        temp_path = '/'.join([temp_dir,os.path.basename(local_path)])
+        put(local_path,temp_path)
+        func('mv -f %s %s && rm -rf %s'% (temp_path,remote_path,temp_dir))
+        return
+
+    chunk_size = env.get('LARGE_FILE_CHUNK_SIZE') or 8388608
+    hashes = _chunk_hashes(local_path, chunk_size)
+    #chunks of the same content are found again by the next attempt. They are kept
+    #in the user's home rather than /tmp where another user could create the directory first
+    chunk_dir = '~/.staging/put-%s'% sha1(''.join(hashes)).hexdigest()[:16]
+    for attempt in range(ATTEMPTS):
+        with settings(hide('running','stdout'),warn_only=True):
+            #chunks an interrupted send left half written still have their .part name
+            existing = run('mkdir -p -m 700 %s && cd %s && pwd && rm -f *.part && (sha1sum %s 2>/dev/null; true)'%
+                           (chunk_dir,chunk_dir,CHUNK_GLOB))
+        if existing.failed:
+            print env.host,"ERROR: Could not create",chunk_dir
+            sys.exit(1)
+        lines = existing.splitlines()
+        #sftp needs the absolute path
+        chunk_dir = lines[0].strip()
+        verified = set([])
+        for line in lines[1:]:
+            fields = line.split()
+            if len(fields) <> 2 or not fields[1].isdigit(): continue
+            chunk_hash, index = fields[0], int(fields[1])
+            if index < len(hashes) and hashes[index] == chunk_hash: verified.add(index)
+        missing = [i for i in range(len(hashes)) if i not in verified]
+        if env.verbosity:
+            print env.host,"Sending %s in %s chunks, %s already on the host"% (os.path.basename(local_path),len(hashes),len(verified))
+        try:
+            _send_chunks(local_path, chunk_dir, chunk_size, missing, env.get('LARGE_FILE_CHANNELS') or 4)
+        except Exception, e:
+            #the chunks that were sent are found again by the next attempt
+            if env.verbosity:
+                print env.host,"WARNING: Sending %s failed: %s. Retrying"% (os.path.basename(local_path),e)
+            continue
+        checksums = ''.join(['%s  %06d\\n'% (h,i) for i, h in enumerate(hashes)])
+        #verify every chunk then reassemble beside the destination and move it into place.
+        #only the check changes directory so a relative remote_path is where put would leave it
+        with settings(warn_only=True):
+            result = func(' && '.join(['(cd %s && printf "%s" | sha1sum -c --quiet -)'% (chunk_dir,checksums),
+                                       'cat %s > %s.woven-part'% (' '.join([_chunk_name(chunk_dir,i) for i in range(len(hashes))]),remote_path),
+                                       'mv -f %s.woven-part %s'% (remote_path,remote_path),
+                                       'rm -rf %s'% chunk_dir]))
+        if not result.failed: return
+        if env.verbosity:
+            print env.host,"WARNING: %s failed verification. Resending the corrupt chunks"% os.path.basename(local_path)
+    print env.host,"ERROR: Could not send",local_path,"to",remote_path
+    sys.exit(1)
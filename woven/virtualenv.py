@@ -4,22 +4,22 @@ import os, sys
 import site
 
 from django import get_version
-from django.template.loader import render_to_string
 
 
 from fabric.decorators import runs_once
 from fabric.state import env 
 from fabric.operations import run, sudo
 from fabric.context_managers import cd, settings
-from fabric.contrib.files import exists
 from fabric.contrib.console import confirm
 
 from woven.decorators import run_once_per_version
-from woven.deployment import mkdirs, deploy_files
+from woven.deployment import _created_dirs, batch, mkdirs, deploy_files, render_template
 from woven.environment import deployment_root,set_version_state, version_state, get_packages
+from woven.environment import compact_state
 from woven.environment import post_exec_hook, State
 from woven.webservers import _get_django_sites, _ls_sites, _sitesettings_files, stop_webserver, start_webserver, webserver_list, domain_sites
-from fabric.contrib.files import append
+from woven.webservers import health_check
+from woven.files import append, exists, forget
 
 def active_version():
     """
@@ -50,7 +50,21 @@ def activate():
 
     active = active_version()
     servers = webserver_list()
+    
+    #a rolling deploy limits how many hosts can have their webservers stopped at once
+    slots = env.get('unavailable_slots')
+    restart = env.patch or active <> env.project_fullname
+    if restart and slots: slots.acquire()
+    try:
+        _activate(env_path, active, servers)
+    finally:
+        if restart and slots: slots.release()
 
+def _activate(env_path, active, servers):
+    """
+    Stops the webservers, activates the version at ``env_path`` if it isn't the ``active``
+    version, then starts the webservers and checks the new version is healthy
+    """
     if env.patch or active <> env.project_fullname:
         for s in servers:
             stop_webserver(s)
@@ -76,20 +90,25 @@ def activate():
         else:
             site_paths = ['/etc/nginx']
         
-        #disable existing sites
-        for path in site_paths:
-            for site in _ls_sites('/'.join([path,'sites-enabled'])):
-                if site not in activate_sites:
-                    sudo("rm %s/sites-enabled/%s"% (path,site))
-        
-        #activate new sites
-        for path in site_paths:
-            for site in activate_sites:
-                if not exists('/'.join([path,'sites-enabled',site])):
-                    sudo("chmod 644 %s" % '/'.join([path,'sites-available',site]))
-                    sudo("ln -s %s/sites-available/%s %s/sites-enabled/%s"% (path,site,path,site))
-                    if env.verbosity:
-                        print " * enabled", "%s/sites-enabled/%s"% (path,site)
+        enabled = []
+        with batch() as b:
+            #disable existing sites
+            for path in site_paths:
+                for site in _ls_sites('/'.join([path,'sites-enabled'])):
+                    if site not in activate_sites:
+                        b.sudo("rm %s/sites-enabled/%s"% (path,site))
+            
+            #activate new sites
+            for path in site_paths:
+                for site in activate_sites:
+                    link = '/'.join([path,'sites-enabled',site])
+                    available = '/'.join([path,'sites-available',site])
+                    enable = b.sudo("if [ ! -e %s ]; then chmod 644 %s && ln -s %s %s && echo enabled; fi"%
+                                    (link,available,available,link))
+                    enabled.append((link,enable))
+        if env.verbosity:
+            for link, enable in enabled:
+                if enable.output: print " * enabled", link
         
         #delete existing symlink
         ln_path = '/'.join([deployment_root(),'env',env.project_name])
@@ -98,6 +117,7 @@ def activate():
         post_exec_hook('post_deploy')
         #activate
         run('ln -s %s %s'% (env_path,ln_path))
+        forget(ln_path)
 
   
         if env.verbosity:
@@ -110,6 +130,9 @@ def activate():
         for s in servers:
             start_webserver(s)
         print
+        if servers and not health_check():
+            print env.host,"ERROR: The health check failed for",env.project_fullname
+            sys.exit(1)
     return
 
 @runs_once
@@ -190,15 +213,18 @@ def mkvirtualenv():
     dirs_created = []
     if env.verbosity:
         print env.host,'CREATING VIRTUALENV', path
-    if not exists(root): dirs_created += mkdirs(root)
-    with cd(root):
-        run(' '.join(["virtualenv",env.project_fullname]))
-    with cd(path):
-        dirs_created += mkdirs('egg_cache')
-        sudo('chown -R %s:www-data egg_cache'% env.user)
-        sudo('chmod -R g+w egg_cache')
-        run(''.join(["echo 'cd ",path,'/','project','/',env.project_package_name,'/sitesettings',"' > bin/postactivate"]))
-        sudo('chmod ugo+rwx bin/postactivate')
+    with batch() as b:
+        root_created = b.run(' '.join(['mkdir -pv',root]))
+        with cd(root):
+            b.run(' '.join(["virtualenv",env.project_fullname]))
+        with cd(path):
+            egg_cache_created = b.run('mkdir -pv egg_cache')
+            b.sudo('chown -R %s:www-data egg_cache'% env.user)
+            b.sudo('chmod -R g+w egg_cache')
+            b.run(''.join(["echo 'cd ",path,'/','project','/',env.project_package_name,'/sitesettings',"' > bin/postactivate"]))
+            b.sudo('chmod ugo+rwx bin/postactivate')
+    for created in [root_created, egg_cache_created]:
+        if created.output: dirs_created += _created_dirs(created.output)
 
     #Create a state
     out = State(' '.join([env.host,'virtualenv',path,'created']))
@@ -215,7 +241,9 @@ def rmvirtualenv():
     if version_state('mkvirtualenv'):
         sudo(' '.join(['rm -rf',path]))
         sudo(' '.join(['rm -f',link]))
-        sudo('rm -f /var/local/woven/%s*'% env.project_fullname)
+        forget(path)
+        forget(link)
+        compact_state()
         set_version_state('mkvirtualenv',delete=True)
       
 
@@ -272,7 +300,7 @@ def pip_install_requirements():
     #if no requirements file exists create one
     if not req_files:
         f = open("requirements.txt","w+")
-        text = render_to_string('woven/requirements.txt', {'django':django_req})
+        text = render_template('woven/requirements.txt', {'django':django_req})
         f.write(text)
         f.close()
         if env.verbosity:
@@ -302,24 +330,24 @@ def pip_install_requirements():
     #install in the env
     out = State(' '.join([env.host,'pip install requirements']))
     python_path = '/'.join([deployment_root(),'env',env.project_fullname,'bin','python'])
+    #cd in the command rather than with cd() which changes env for any concurrent deploy steps
     with settings(warn_only=True):
-        with cd(remote_dir):
-            for req in req_files_list:
-                bundle = req_files[req]
-                if bundle: req=bundle
-                if env.verbosity:
-                    print ' * installing',req
-                if '.zip' in req.lower():
-                    install = run('pip install %s -q --environment=%s --log=/home/%s/.pip/%s_pip_log.txt'%
-                                  (req, python_path, env.user, req.replace('.','_')))
-                  
-                else:
-                    install = run('pip install -q --environment=%s --src=%s --download-cache=%s --requirement=%s --log=/home/%s/.pip/%s_pip_log.txt'%
-                                  (python_path,src,cache,req, env.user,req.replace('.','_')))
-                if install.failed:
-                    out.failed =True
-                    out.stderr += ' '.join([env.host, "ERROR INSTALLING",req,'\n'])
-    
+        for req in req_files_list:
+            bundle = req_files[req]
+            if bundle: req=bundle
+            if env.verbosity:
+                print ' * installing',req
+            if '.zip' in req.lower():
+                install = run('cd %s && pip install %s -q --environment=%s --log=/home/%s/.pip/%s_pip_log.txt'%
+                              (remote_dir, req, python_path, env.user, req.replace('.','_')))
+              
+            else:
+                install = run('cd %s && pip install -q --environment=%s --src=%s --download-cache=%s --requirement=%s --log=/home/%s/.pip/%s_pip_log.txt'%
+                              (remote_dir, python_path,src,cache,req, env.user,req.replace('.','_')))
+            if install.failed:
+                out.failed =True
+                out.stderr += ' '.join([env.host, "ERROR INSTALLING",req,'\n'])
+
     out.object = deployed
               
     if out.failed:
@@ -1,16 +1,21 @@
 #!/usr/bin/env python
-import os,socket, sys
+import os,socket, sys, time
+import urllib2
 import json
+from hashlib import sha1
+
 
 from fabric.state import _AttributeDict, env
 from fabric.operations import run, sudo
 from fabric.context_managers import cd, settings
-from fabric.contrib.files import append, contains, exists
 from fabric.decorators import runs_once
 
 from woven.decorators import run_once_per_version
-from woven.deployment import deploy_files, mkdirs, upload_template
+from woven.deployment import Batch, deploy_files, mkdirs, render_template, upload_template, upload_templates
 from woven.environment import deployment_root, version_state, _root_domain, get_packages
+from woven.facts import host_facts, template_facts
+from woven.files import append, contains, exists, forget
+from woven.packages import package_installed
 from woven.linux import add_user
 
 def _activate_sites(path, filenames):
@@ -25,16 +30,17 @@ def _activate_sites(path, filenames):
         if not exists('/etc/apache2/sites-enabled'+ filename):
             sudo("ln -s %s%s %s%s"% (self.deploy_root,filename,self.enabled_path,filename))
 
-def _deploy_webconf(remote_dir,template):
-    
+def _webconf_contexts(remote_dir):
+    """
+    Returns a list of (filename, context) for each domain's site configuration
+    """
     if not 'http:' in env.MEDIA_URL: media_url = env.MEDIA_URL
     else: media_url = ''
     if not 'http:' in env.STATIC_URL: static_url = env.STATIC_URL
     else: static_url = ''
     if not static_url: static_url = env.ADMIN_MEDIA_PREFIX
-    log_dir = '/'.join([deployment_root(),'log'])
-    deployed = []
-    users_added = []
+    contexts = []
+    facts = host_facts()
     
     domains = domain_sites()
     for d in domains:
@@ -50,21 +56,29 @@ def _deploy_webconf(remote_dir,template):
                     "user":env.user,
                     "site_user":site_user,
                     "SITE_ID":d.site_id,
-                    "host_ip":socket.gethostbyname(env.host),
+                    "host_ip":facts.ip,
+                    "facts":template_facts(),
                     "wsgi_filename":wsgi_filename,
                     "MEDIA_URL":media_url,
                     "STATIC_URL":static_url,
                     }
+        contexts.append((filename,context))
+    return contexts
 
-        upload_template('/'.join(['woven',template]),
-                        filename,
-                        context,
-                        use_sudo=True)
-        if env.verbosity:
+def _deploy_webconf(remote_dir,template):
+    deployed = []
+    users_added = []
+    contexts = _webconf_contexts(remote_dir)
+    uploaded = upload_templates([('/'.join(['woven',template]),filename,context) for filename, context in contexts],
+                                use_sudo=True)
+    if env.verbosity:
+        for filename in uploaded:
             print " * uploaded", filename
             
-        #add site users if necessary
-        site_users = _site_users()
+    #add site users if necessary
+    site_users = _site_users()
+    for filename, context in contexts:
+        site_user = context['site_user']
         if site_user not in users_added and site_user not in site_users:
             add_user(username=site_user,group='www-data',site_user=True)
             users_added.append(site_user)
@@ -124,24 +138,24 @@ def _get_django_sites():
     """
     deployed = version_state('deploy_project')
     if not env.sites and 'django.contrib.sites' in env.INSTALLED_APPS and deployed:
-        with cd('/'.join([deployment_root(),'env',env.project_fullname,'project',env.project_package_name,'sitesettings'])):
-            venv = '/'.join([deployment_root(),'env',env.project_fullname,'bin','activate'])
-            #since this is the first time we run ./manage.py on the server it can be
-            #a point of failure for installations
-            with settings(warn_only=True):
-                output = run(' '.join(['source',venv,'&&',"django-admin.py dumpdata sites --settings=%s.sitesettings.settings"% env.project_package_name]))
-
-                if output.failed:
-                    print "ERROR: There was an error running ./manage.py on the node"
-                    print "See the troubleshooting docs for hints on how to diagnose deployment issues"
-                    if hasattr(output, 'stderr'):
-                        print output.stderr
-                    sys.exit(1)
-            output = output.split('\n')[-1] #ignore any lines prior to the data being dumped
-            sites = json.loads(output)
-            env.sites = {}
-            for s in sites:
-                env.sites[s['pk']] = s['fields']['domain']
+        sitesettings = '/'.join([deployment_root(),'env',env.project_fullname,'project',env.project_package_name,'sitesettings'])
+        venv = '/'.join([deployment_root(),'env',env.project_fullname,'bin','activate'])
+        #since this is the first time we run ./manage.py on the server it can be
+        #a point of failure for installations
+        with settings(warn_only=True):
+            output = run(' '.join(['cd',sitesettings,'&&','source',venv,'&&',"django-admin.py dumpdata sites --settings=%s.sitesettings.settings"% env.project_package_name]))
+
+            if output.failed:
+                print "ERROR: There was an error running ./manage.py on the node"
+                print "See the troubleshooting docs for hints on how to diagnose deployment issues"
+                if hasattr(output, 'stderr'):
+                    print output.stderr
+                sys.exit(1)
+        output = output.split('\n')[-1] #ignore any lines prior to the data being dumped
+        sites = json.loads(output)
+        env.sites = {}
+        for s in sites:
+            env.sites[s['pk']] = s['fields']['domain']
     return env.sites
 
 def domain_sites():
@@ -180,23 +194,42 @@ def domain_sites():
             
     return env.domains
 
-@run_once_per_version
+def _webconf_templates():
+    """
+    Returns a list of (remote_dir, template) site configurations for the installed packages
+    """
+    if 'apache2' in get_packages():
+        return [('/etc/apache2/sites-available','django-apache-template.txt'),
+                ('/etc/nginx/sites-available','nginx-template.txt')]
+    elif 'gunicorn' in get_packages():
+        return [('/etc/nginx/sites-available','nginx-gunicorn-template.txt')]
+    return []
+
+def _webconf_fingerprint():
+    """
+    A hash of the rendered site configurations
+    """
+    fingerprint = sha1(render_template('woven/maintenance.html',{}))
+    for remote_dir, template in _webconf_templates():
+        for filename, context in _webconf_contexts(remote_dir):
+            fingerprint.update(filename)
+            fingerprint.update(render_template('/'.join(['woven',template]),context))
+    return fingerprint.hexdigest()
+
+@run_once_per_version(fingerprint=_webconf_fingerprint)
 def deploy_webconf():
     """ Deploy nginx and other wsgi server site configurations to the host """
     deployed = []
     log_dir = '/'.join([deployment_root(),'log'])
-    #TODO - incorrect - check for actual package to confirm installation
     if webserver_list():
         if env.verbosity:
             print env.host,"DEPLOYING webconf:"
         if not exists(log_dir):
             run('ln -s /var/log log')
+            forget(log_dir)
         #deploys confs for each domain based on sites app
-        if 'apache2' in get_packages():
-            deployed += _deploy_webconf('/etc/apache2/sites-available','django-apache-template.txt')
-            deployed += _deploy_webconf('/etc/nginx/sites-available','nginx-template.txt')
-        elif 'gunicorn' in get_packages():
-            deployed += _deploy_webconf('/etc/nginx/sites-available','nginx-gunicorn-template.txt')
+        for remote_dir, template in _webconf_templates():
+            deployed += _deploy_webconf(remote_dir,template)
             
         upload_template('woven/maintenance.html','/var/www/nginx-default/maintenance.html',use_sudo=True)
         sudo('chmod ugo+r /var/www/nginx-default/maintenance.html')
@@ -233,53 +266,56 @@ def deploy_wsgi():
     if env.verbosity:
         print env.host,"DEPLOYING wsgi", wsgi, remote_dir
 
+    deployed += mkdirs(remote_dir)
+    permissions = Batch()
     for file in _sitesettings_files(): 
-        deployed += mkdirs(remote_dir)
-        with cd(remote_dir):
-            settings_module = file.replace('.py','')
-            context = {"deployment_root":deployment_root(),
-                       "user": env.user,
-                       "project_name": env.project_name,
-                       "project_package_name": env.project_package_name,
-                       "project_apps_path":env.PROJECT_APPS_PATH,
-                       "settings": settings_module,
-                       }
-            if wsgi == 'apache2':
-                filename = file.replace('.py','.wsgi')
-                upload_template('/'.join(['woven','django-wsgi-template.txt']),
-                                filename,
-                                context,
-                            )
-            elif wsgi == 'gunicorn':
-                filename = 'gunicorn-%s.conf'% env.project_name
-                upload_template('/'.join(['woven','gunicorn.conf']),
-                                filename,
-                                context,
-                                backup=False,
-                                use_sudo=True
-                            )                
-                
-            if env.verbosity:
-                print " * uploaded", filename
-            #finally set the ownership/permissions
-            #We'll use the group to allow www-data execute
-            if wsgi == 'apache2':
-                sudo("chown %s:www-data %s"% (env.user,filename))
-                run("chmod ug+xr %s"% filename)
-            elif wsgi == 'gunicorn':
-                sudo("chown root:root %s"% filename)
-                sudo("chmod go+r %s"% filename)
-                
+        settings_module = file.replace('.py','')
+        context = {"deployment_root":deployment_root(),
+                   "user": env.user,
+                   "project_name": env.project_name,
+                   "project_package_name": env.project_package_name,
+                   "project_apps_path":env.PROJECT_APPS_PATH,
+                   "settings": settings_module,
+                   }
+        if wsgi == 'apache2':
+            filename = '/'.join([remote_dir,file.replace('.py','.wsgi')])
+            upload_template('/'.join(['woven','django-wsgi-template.txt']),
+                            filename,
+                            context,
+                        )
+        elif wsgi == 'gunicorn':
+            filename = '/'.join([remote_dir,'gunicorn-%s.conf'% env.project_name])
+            upload_template('/'.join(['woven','gunicorn.conf']),
+                            filename,
+                            context,
+                            backup=False,
+                            use_sudo=True
+                        )                
+            
+        if env.verbosity:
+            print " * uploaded", filename
+        #finally set the ownership/permissions
+        #We'll use the group to allow www-data execute
+        if wsgi == 'apache2':
+            permissions.sudo("chown %s:www-data %s"% (env.user,filename))
+            permissions.run("chmod ug+xr %s"% filename)
+        elif wsgi == 'gunicorn':
+            permissions.sudo("chown root:root %s"% filename)
+            permissions.sudo("chmod go+r %s"% filename)
+    permissions.execute()
+            
     return deployed
 
+
 def webserver_list():
     """
-    list of webserver packages
+    list of webserver packages that are configured and installed on the host
     """
     p = set(get_packages())
     w = set(['apache2','gunicorn','uwsgi','nginx'])
-    installed = p & w
+    installed = set([s for s in p & w if package_installed(s)])
     return list(installed)
+
     
 def reload_webservers():
     """
@@ -364,4 +400,34 @@ def start_webserver(server):
             
     return True
 
-    
\ No newline at end of file
+    
+def health_check(url='', timeout=None):
+    """
+    Requests ``url`` (defaults to the HEALTH_CHECK_URL setting) until it responds
+    successfully or ``timeout`` seconds (defaults to HEALTH_CHECK_TIMEOUT) have passed.
+    
+    A url path such as /health/ is requested from the current host with the
+    root domain as the Host header.
+    
+    Returns True if the check passed or no url is set
+    """
+    url = url or env.get('HEALTH_CHECK_URL','')
+    if not url: return True
+    if timeout is None: timeout = env.get('HEALTH_CHECK_TIMEOUT',60)
+    headers = {}
+    if url[0] == '/':
+        headers['Host'] = env.get('root_domain') or env.host
+        url = ''.join(['http://',env.host,url])
+    deadline = time.time() + timeout
+    while True:
+        try:
+            response = urllib2.urlopen(urllib2.Request(url, headers=headers), timeout=10)
+            if env.verbosity:
+                print env.host,"HEALTH CHECK",url,response.code
+            return True
+        except (urllib2.URLError, socket.error), e:
+            error = e
+        if time.time() > deadline: break
+        time.sleep(2)
+    print env.host,"HEALTH CHECK FAILED",url,error
+    return False